@@ -1,51 +1,76 @@
 #!/usr/bin/env python3
+import time
+import_started = time.perf_counter()
+
 from sys import exit
+import sys
 from pprint import pprint
 
-import pyperclip
 import configparser
 import asyncio
-import time
-import math
 import re
+import threading
 
-import spotipy
 from spotipy.oauth2 import SpotifyOAuth
+from spotify_async import AsyncSpotify, PrivateCacheFileHandler, MAX_PLAYLIST_BATCH
+from now_playing import NowPlaying
+from search_cache import SearchCache, SearchStore
+from track_index import TrackIndex
+from request_batch import RequestBatcher
+from channel import MESSAGES, Channel
+from playlist import PlaylistIndex, fetch_tracks, read_cache, write_cache
+from credits import CreditLedger, CreditStore
+from donations import EVENTS, SIGNAL_BOTS, DonationParser
+from chat_queue import ChatSender, MOD_LIMIT, USER_LIMIT, PRIORITY_REPLY, PRIORITY_SONG, join_names
+from functools import partial
+from status_log import StatusWriter, format_record
 
 from twitchAPI.twitch import Twitch
 from twitchAPI.oauth import UserAuthenticator
-#from twitchAPI.oauth import UserAuthenticationStorageHelper
 from oauth_web import UserAuthenticator_custom
-#from oauth_web import UserAuthenticationStorageHelper_custom
+from oauth_web import UserAuthenticationStorageHelper_custom
 from twitchAPI.type import AuthScope, ChatEvent
 from twitchAPI.chat import Chat, EventData, ChatMessage, ChatSub, ChatCommand
 
-from twisted.web import server, resource, static
-from twisted.internet import reactor
-from twisted.web.util import redirectTo
-
-import html
-import json
+import itertools
+from collections import deque
 
 from jinja2 import Environment, FileSystemLoader
 
-from markdown import markdown
-
-import bcrypt
-from getpass import getpass
+#the web ui, markdown, bcrypt and the clipboard are imported on first use
+import_time = time.perf_counter() - import_started
 
 #global variables
 app_name = 'BopBot'
-tippers = {}
-playlist_tracks = []
-sp = 0
+ledger = None
+donations = None
+channels = {}
+channel = None
+track_index = TrackIndex()
+#shared by all channels, results for tracks still in a playlist never expire
+search_cache = SearchCache(None, pinned=lambda track_id:
+        any(track_id in ch.playlist_tracks for ch in channels.values()))
 env = Environment(loader=FileSystemLoader('templates/'))
 cfg = configparser.ConfigParser()
 error = None
 quit = False
-auth_sessions = []
-status_file = None
+quit_event = asyncio.Event()
+chat_ready = asyncio.Event()
+spotify_login = asyncio.Lock()
+web = None
+console = None
+status_writer = StatusWriter()
+#channels this process serves when started as a worker, see supervisor.py
+shard = None
+supervisor = None
+handoff = False
+status_events = deque(maxlen=500)
+status_ids = itertools.count(1)
+status_listeners = []
 chat = None
+twitch = None
+sender = None
+startup_timings = {}
 
 BOPBOT_WEB = False
 TWITCH_CLIENT_ID = ''
@@ -60,6 +85,7 @@ GIFTED_REGEX = ''
 BITS_REGEX = ''
 TIP_REGEX = ''
 SIGNAL_BOT =''
+BOT_MODERATOR = False
 TWITCH_REQUEST_URI = ''
 AMOUNT_BITS = 0
 AMOUNT_GIFTED_TIER1 = 0
@@ -74,19 +100,31 @@ DISABLE_CREDIT_CMD = False
 DISABLE_SONG_CMD = False
 DISABLE_REQUEST_CMD = False
 CUMULATIVE_CREDIT = True
+DATABASE = 'bopbot.db'
+TWITCH_TOKEN_FILE = 'twitch_token.json'
+SPOTIFY_TOKEN_FILE = 'spotify_token.json'
 CREDIT_MESSAGE = ''
 SONG_MESSAGE = ''
 NO_SONG_MESSAGE = ''
 REQUEST_MESSAGE = ''
 NOTIFY_MESSAGE = ''
+NOTIFY_BATCH_MESSAGE = ''
 
+#queue a status record, the writer thread formats and writes it
 def status(*args):
-    d = ' '.join(map(str,args))
-    global status_file
-    if status_file:
-        status_file.write(d + '\n')
-    else:
-        print(d)
+    record = (next(status_ids), time.time(), args)
+    status_writer.put(record)
+
+    #keep recent lines in memory and push them to the admin pages
+    status_events.append(record)
+    if status_listeners:
+        data = status_event(record)
+        for request in status_listeners:
+            request.write(data)
+
+def status_event(record):
+    lines = ''.join('data: ' + line + '\n' for line in format_record(record).split('\n'))
+    return ('id: ' + str(record[0]) + '\n' + lines + '\n').encode('utf-8')
 
 def fail(*args):
     global error
@@ -111,6 +149,7 @@ def read_conf():
     global BITS_REGEX
     global TIP_REGEX
     global SIGNAL_BOT
+    global BOT_MODERATOR
     global TWITCH_REQUEST_URI
     global AMOUNT_BITS
     global AMOUNT_GIFTED_TIER1
@@ -125,16 +164,19 @@ def read_conf():
     global DISABLE_SONG_CMD
     global DISABLE_REQUEST_CMD
     global CUMULATIVE_CREDIT
+    global DATABASE
     global CREDIT_MESSAGE
     global SONG_MESSAGE
     global NO_SONG_MESSAGE
     global REQUEST_MESSAGE
     global NOTIFY_MESSAGE
+    global NOTIFY_BATCH_MESSAGE
 
     try:
         cfg.read('config.ini')
 
-        BOPBOT_WEB = cfg.getboolean('bopbot', 'bopbot_web', fallback=False)
+        #workers are driven by the supervisor, which serves the web ui
+        BOPBOT_WEB = cfg.getboolean('bopbot', 'bopbot_web', fallback=False) and shard is None
 
         TWITCH_CLIENT_ID = cfg['twitch']['client_id']
         TWITCH_SECRET = cfg['twitch']['secret_key']
@@ -154,6 +196,7 @@ def read_conf():
         TIP_REGEX = cfg.get('twitch', 'tip_regex', fallback='Thank you .* for tipping \$(0|[1-9][0-9])*\.(0|[0-9][0-9])??!')
 
         SIGNAL_BOT = cfg.get('twitch', 'signal_bot', fallback='Streamlabs')
+        BOT_MODERATOR = cfg.getboolean('twitch', 'moderator', fallback=False)
         TWITCH_REQUEST_URI = cfg.get('twitch', 'request_uri', fallback='http://localhost:17563')
 
         AMOUNT_BITS = cfg.getint('cost', 'amount_bits', fallback=10000)
@@ -170,16 +213,21 @@ def read_conf():
         DISABLE_SONG_CMD = cfg.getboolean('bopbot', 'disable_song_cmd', fallback=False)
         DISABLE_REQUEST_CMD = cfg.getboolean('bopbot', 'disable_request_cmd', fallback=False)
         CUMULATIVE_CREDIT = cfg.getboolean('bopbot', 'cumulative_credit', fallback=True)
+        DATABASE = cfg.get('bopbot', 'database', fallback='bopbot.db')
 
-        CREDIT_MESSAGE = cfg.get('messages', 'credit_message', fallback="f'@{username}, you have {credit} song request credit(s).")
-        SONG_MESSAGE = cfg.get('messages', 'song_message', fallback="f'@{username}, current song is {name} by {artist}.'")
-        NO_SONG_MESSAGE = cfg.get('messages', 'no_song_message', fallback="f'@{username}, there is currently no song playing.'")
-        REQUEST_MESSAGE = cfg.get('messages', 'request_message', fallback="f'@{username}, added {name} by {artist} to the playlist.'")
-        NOTIFY_MESSAGE = cfg.get('messages', 'notify_message', fallback="f'@{username}, you now have {credit} song request credit(s).'")
+        CREDIT_MESSAGE = cfg.get('messages', 'credit_message', fallback='@{{username}}, you have {{credit}} song request credit(s).')
+        SONG_MESSAGE = cfg.get('messages', 'song_message', fallback='@{{username}}, current song is {{name}} by {{artist}}.')
+        NO_SONG_MESSAGE = cfg.get('messages', 'no_song_message', fallback='@{{username}}, there is currently no song playing.')
+        REQUEST_MESSAGE = cfg.get('messages', 'request_message', fallback='@{{username}} added {{name}} by {{artist}} to the playlist.')
+        NOTIFY_MESSAGE = cfg.get('messages', 'notify_message', fallback='@{{username}}, you now have {{credit}} song request credit(s).')
+        NOTIFY_BATCH_MESSAGE = cfg.get('messages', 'notify_batch_message', fallback='{{usernames}} now have song request credits.')
 
         if BOPBOT_WEB:
-            global status_file
-            status_file = open('./status_file.txt', 'w')
+            status_writer.max_bytes = cfg.getint('bopbot', 'status_max_bytes', fallback=1024*1024)
+            status_writer.reopen(cfg.get('bopbot', 'status_file', fallback='./status_file.txt'),
+                    cfg.getboolean('bopbot', 'status_json', fallback=False))
+
+        return build_channels() or compile_messages() or build_donations()
 
 
 def save_conf(request):
@@ -215,6 +263,7 @@ def save_conf(request):
     global NO_SONG_MESSAGE
     global REQUEST_MESSAGE
     global NOTIFY_MESSAGE
+    global NOTIFY_BATCH_MESSAGE
 
     if BOPBOT_WEB:
             inputs = request.args#[]
@@ -268,6 +317,7 @@ def save_conf(request):
             NO_SONG_MESSAGE = inputs[b'no_song_message'][0].decode('utf-8')
             REQUEST_MESSAGE = inputs[b'request_message'][0].decode('utf-8')
             NOTIFY_MESSAGE = inputs[b'notify_message'][0].decode('utf-8')
+            NOTIFY_BATCH_MESSAGE = inputs[b'notify_batch_message'][0].decode('utf-8')
 
     cfg.set('twitch', 'client_id', str(TWITCH_CLIENT_ID))
     cfg.set('twitch', 'secret_key', str(TWITCH_SECRET))
@@ -299,6 +349,10 @@ def save_conf(request):
     cfg.set('messages', 'no_song_message', str(NO_SONG_MESSAGE))
     cfg.set('messages', 'request_message', str(REQUEST_MESSAGE))
     cfg.set('messages', 'notify_message', str(NOTIFY_MESSAGE))
+    cfg.set('messages', 'notify_batch_message', str(NOTIFY_BATCH_MESSAGE))
+
+    er = compile_messages() or build_donations()
+    if er: return er
 
     try:
         f = open('config.ini', 'w')
@@ -308,130 +362,208 @@ def save_conf(request):
         return fail('Error writing to "config.ini".', str(r))
 
 
-#cache the playlist into a list
-def cache_playlist():
-
-    status('Caching playlist...')
+#the primary channel and one [channel:<name>] section per partner channel
+def build_channels():
+
+    global channels
+    global channel
+
+    primary = Channel(TARGET_CHANNEL, SPOTIFY_PLAYLIST_URL, SPOTIFY_CLIENT_ID, SPOTIFY_SECRET,
+            SPOTIFY_TOKEN_FILE)
+    found = {primary.name.lower(): primary}
+    for section in cfg.sections():
+        if section.startswith('channel:'):
+            name = section.split(':', 1)[1].strip()
+            found[name.lower()] = Channel(name,
+                    cfg.get(section, 'playlist_url', fallback=''),
+                    cfg.get(section, 'spotify_client_id', fallback=SPOTIFY_CLIENT_ID),
+                    cfg.get(section, 'spotify_secret_key', fallback=SPOTIFY_SECRET),
+                    cfg.get(section, 'spotify_token_file', fallback='spotify_token.' + name + '.json'),
+                    {m: cfg.get(section, m + '_message') for m in MESSAGES
+                            if cfg.has_option(section, m + '_message')})
+    if shard is not None:
+        found = {name: ch for name, ch in found.items() if name in shard}
+        if not found:
+            return fail('None of the channels', ', '.join(shard), 'is configured.')
+    channels = found
+
+    #the console keeps working on the channel it had selected
+    if channel is None or not channel.name.lower() in channels:
+        channel = channels.get(primary.name.lower(), next(iter(channels.values())))
+    else:
+        channel = channels[channel.name.lower()]
+
+#compile the chat reply templates of every channel once per config change
+def compile_messages():
+
+    defaults = {
+        'credit': CREDIT_MESSAGE,
+        'song': SONG_MESSAGE,
+        'no_song': NO_SONG_MESSAGE,
+        'request': REQUEST_MESSAGE,
+        'notify': NOTIFY_MESSAGE,
+        'notify_batch': NOTIFY_BATCH_MESSAGE,
+    }
+    try:
+        for ch in channels.values():
+            ch.messages = {m: env.from_string(ch.templates.get(m, defaults[m])) for m in MESSAGES}
+    except Exception as r:
+        return fail('Error in message templates.', str(r))
+
+#compile the signal bot patterns and cost table once per config change.
+#SIGNAL_BOT may list several bots; StreamElements and Fossabot come with
+#patterns for their default alerts, any other bot uses the [twitch] patterns.
+#bots with their own patterns get a [signal_bot:<name>] section
+def build_donations():
+
+    global donations
+
+    patterns = {'tip': TIP_REGEX, 'bits': BITS_REGEX, 'gifted': GIFTED_REGEX}
+    bots = {}
+    for name in SIGNAL_BOT.split(','):
+        if name.strip():
+            bots[name.strip()] = SIGNAL_BOTS.get(name.strip().lower(), patterns)
+    for section in cfg.sections():
+        if section.startswith('signal_bot:'):
+            name = section.split(':', 1)[1].strip()
+            defaults = SIGNAL_BOTS.get(name.lower(), {})
+            bots[name] = {e: cfg.get(section, e + '_regex', fallback=defaults.get(e, ''))
+                    for e in EVENTS}
 
-    global playlist_tracks
-    offset = 0
     try:
-        while True:
-            response = sp.playlist_items('spotify:playlist:' + SPOTIFY_PLAYLIST_URI,
-                    offset=offset,
-                    fields='items.track.id,items.track.uri,total',
-                    additional_types=['track'])
+        costs = {
+            ('tip', None): float(AMOUNT_TIP),
+            ('bits', None): int(AMOUNT_BITS),
+            ('gifted', 1): int(AMOUNT_GIFTED_TIER1),
+            ('gifted', 2): int(AMOUNT_GIFTED_TIER2),
+            ('gifted', 3): int(AMOUNT_GIFTED_TIER3),
+        }
+        donations = DonationParser(bots, costs, CUMULATIVE_CREDIT)
+    except Exception as r:
+        return fail('Error in signal bot configuration.', str(r))
 
-            if len(response['items']) == 0:
-                break
-            
-            playlist_tracks.append(response['items'])
+#cache the playlist into an index, reusing the copy on disk
+#when the playlist snapshot did not change
+async def cache_playlist(ch):
 
-            offset = offset + len(response['items'])
+    status('Caching playlist of', ch.name + '...')
 
-        playlist_tracks = playlist_tracks[0]
-        for track in playlist_tracks:
-            track['track']['requested'] = False
+    await flush_playlist(ch)
+    try:
+        loop = asyncio.get_running_loop()
+        cached, snapshot = await asyncio.gather(
+                loop.run_in_executor(None, read_cache, ch.cache_path()),
+                ch.sp.playlist(ch.playlist_uri, fields='snapshot_id'))
+
+        #caches written before track names were stored are fetched again
+        if cached and 'names' in cached and cached['snapshot_id'] == snapshot['snapshot_id']:
+            ch.playlist_tracks = PlaylistIndex.load(cached)
+            track_index.update(ch.playlist_tracks)
+            status('Loaded', len(ch.playlist_tracks), 'track(s) from disk.')
+            return
+
+        tracks = await fetch_tracks(ch.sp, 'spotify:playlist:' + ch.playlist_uri)
+        ch.playlist_tracks = PlaylistIndex(tracks)
+        ch.playlist_tracks.snapshot_id = snapshot['snapshot_id']
+        if cached:
+            ch.playlist_tracks.restore_requested(cached)
+        track_index.update(ch.playlist_tracks)
+        status('Cached', len(ch.playlist_tracks), 'track(s).')
+        save_playlist(ch)
     except Exception as r:
-        return fail('Error getting Spotify playlist.', str(r))
+        return fail('Error getting Spotify playlist of', ch.name + '.', str(r))
+
+#write the playlist cache to disk, coalescing bursts of edits
+def save_playlist(ch, delay = 1.0):
+
+    ch.playlist_dirty = True
+    if ch.playlist_save and not ch.playlist_save.done():
+        return
+
+    async def save():
+        await asyncio.sleep(delay)
+        #edits made while the last copy was being written get another round
+        while ch.playlist_dirty:
+            ch.playlist_dirty = False
+            data = ch.playlist_tracks.dump()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, write_cache, ch.cache_path(), data)
+            except Exception as r:
+                status('Error saving playlist cache.', str(r))
+
+    ch.playlist_save = asyncio.ensure_future(save())
+
+async def flush_playlist(ch):
+    if ch.playlist_save:
+        await ch.playlist_save
 
 async def room_join(chn): 
-    status('Joining channel:', chn)
+    status('Joining channel:', ', '.join(chn) if isinstance(chn, list) else chn)
     global chat
     await chat.join_room(chn)
 
+#the channel context a chat message belongs to
+def channel_of(msg):
+    if msg.room is None:
+        return None
+    return channels.get(msg.room.name.lower())
+
 #setup playlist when Twitch is ready and Spotify connection established
 async def on_ready(ready_event: EventData):
 
     status(app_name, 'is ready.')
     status()
     help()
+    chat_ready.set()
 
 #parse signal bot chat notifications and calculate
 #tippers credit for song requests
 async def on_message(msg: ChatMessage):
 
     if DISABLE_REQUEST_CMD: return
-
-    global tippers
-    global playlist_tracks
-
-    if msg.user.name.lower() == SIGNAL_BOT.lower():
-
-        #Parsing streamlabs chat notifications, for example:
-        #   Thank you username for donating 100 bits
-        #   username just gifted 1 Tier 1 subscriptions!
-        #   Thank you username for tipping $1.00!
-
-        tipper = ''
-        amount = 0
-        credit = tippers.get(msg.user.name.lower(),0)
-
-        r = re.match(TIP_REGEX, msg.text)
-        if r:
-            amount = float(r.groups()[1])
-            if amount >= AMOUNT_TIP:
-                tipper = r.groups()[0]
-                if CUMULATIVE_CREDIT:
-                    #TODO currency conversion
-                    credit += math.floor(amount/AMOUNT_TIP)
-                else:
-                    credit = 1
-
-        r = re.match(BITS_REGEX, msg.text)
-        if r:
-            amount = int(r.groups()[1])
-            if amount >= AMOUNT_BITS:
-                tipper = r.groups()[0]
-                if CUMULATIVE_CREDIT:
-                    credit += math.floor(amount/AMOUNT_BITS)
-                else:
-                    credit = 1
-
-        r = re.match(GIFTED_REGEX, msg.text)
-        if r:
-            tier = r.groups()[2]
-            amount = int(r.groups()[1])
-            if int(tier) == 1 and amount >= AMOUNT_GIFTED_TIER1:
-                tipper = r.groups()[0]
-                if CUMULATIVE_CREDIT:
-                    credit += math.floor(amount/AMOUNT_GIFTED_TIER1)
-                else:
-                    credit = 1
-            if int(tier) == 2 and amount >= AMOUNT_GIFTED_TIER2:
-                tipper = r.groups()[0]
-                if CUMULATIVE_CREDIT:
-                    credit += math.floor(amount/AMOUNT_GIFTED_TIER2)
-                else:
-                    credit = 1
-            if int(tier) == 3 and amount >= AMOUNT_GIFTED_TIER3:
-                tipper = r.groups()[0]
-                if CUMULATIVE_CREDIT:
-                    credit += math.floor(amount/AMOUNT_GIFTED_TIER3)
-                else:
-                    credit = 1
-
-        if tipper:
-            tippers[tipper.lower()] = math.floor(credit)
-            credit = str(credit)
-            username = tipper
-            status(username, 'now has', credit,'song request credit(s)')
-            await msg.chat.send_message(TARGET_CHANNEL, \
-                env.fromg_string(NOTIFY_MESSAGE).render(username=username,credit=credit))
+    ch = channel_of(msg)
+    if not ch: return
+
+    #Parsing signal bot chat notifications, for example:
+    #   Thank you username for donating 100 bits
+    #   username just gifted 1 Tier 1 subscriptions!
+    #   Thank you username for tipping $1.00!
+    donation = donations.parse(msg.user.name, msg.text)
+
+    if donation and donation.credit:
+        tipper = donation.username
+        if CUMULATIVE_CREDIT:
+            credit = ch.tippers.add(tipper, donation.credit, donation.event)
+        else:
+            credit = ch.tippers.set(tipper, donation.credit, donation.event)
+        credit = str(credit)
+        username = tipper
+        status(username, 'now has', credit,'song request credit(s) in', ch.name)
+        sender.put_group(('notify', ch.name), (username, credit), partial(merge_notify, ch))
+
+#one notification per tipper, or a single line for a burst of them
+def merge_notify(ch, items):
+    if len(items) == 1:
+        username, credit = items[0]
+        text = ch.render('notify', username=username, credit=credit)
+    else:
+        usernames = []
+        for username, credit in items:
+            if not username in usernames:
+                usernames.append(username)
+        text = ch.render('notify_batch', usernames=join_names(usernames))
+    return partial(chat.send_message, ch.name, text)
 
 #give 1 credit to user
 def give(username = ''):
     if username:
-        if username.lower() in tippers.keys():
-            tippers[username.lower()] += 1
-        else:
-            tippers[username.lower()] = 1
+        channel.tippers.add(username, 1, 'give')
 
 
 #display help
 def help(command = ''):
     if command == '':
-        status('Commands: stop, start, tippers, refresh, reset, give, help, quit (or exit). For further help, type \
+        status('Commands: stop, start, tippers, refresh, reset, give, source, channel, cache, spotify, timings, shards, workers, help, quit (or exit). For further help, type \
 "help <command>".')
     if command == 'quit':
         status('The "quit" command deactivates', app_name, 'and exits the program.')
@@ -449,114 +581,163 @@ credit associated with each tipper.')
     if command == 'stop':
         status('The "stop" command disables song requests.')
     if command == 'give':
-        status('The "give <username>" command will give 1 credit to <username>.')
+        status('The "give <username> [<username> ...]" command will give 1 credit to each <username>.')
+    if command == 'source':
+        status('The "source <file>" command runs the commands in <file>, one per line.')
+    if command == 'channel':
+        status('The "channel [<name>]" command lists the channels and picks the one give, tippers, \
+playlist and spotify work on.')
+    if command == 'spotify':
+        status('The "spotify" command shows whether Spotify calls are going through or failing fast.')
+    if command == 'cache':
+        status('The "cache" command shows the hit rates of the local song index and the search cache.')
+    if command == 'timings':
+        status('The "timings" command shows how long the last startup took, stage by stage.')
+    if command == 'shards':
+        status('The "shards" command lists the worker processes and the channels each one serves.')
+    if command == 'workers':
+        status('The "workers <count>" command starts or stops workers until <count> are running, \
+moving only the channels whose worker changed.')
+
+#hold new requests of a channel and write out the ones already queued,
+#so nothing lands in the playlist while it is cleaned or cached again
+async def pause_requests(ch):
+    ch.playlist_ready.clear()
+    if ch.batcher:
+        await ch.batcher.flush()
 
 #if clean_playlist is specificed in config.ini
 #then when program is reset or exited it will
 #remove all the requested songs from the playlist
 #to preserve the original curated playlist
-def clean_playlist():
+async def clean_playlist(ch):
 
     global CLEAN_PLAYLIST
-    if not CLEAN_PLAYLIST: return
+    if not CLEAN_PLAYLIST or not ch.sp: return
 
-    status('Removing requested songs from playlist...')
+    status('Removing requested songs from the playlist of', ch.name + '...')
 
-    i = 0
-    for track in playlist_tracks:
+    playlist_tracks = ch.playlist_tracks
+    requested = playlist_tracks.requested()
+    snapshot_id = playlist_tracks.snapshot_id
 
-        if track['track']['requested']:
-            tid = track['track']['id']
-            pos = track['track']['pos'] - i
-            track_ids = []
-            track_ids.append({'uri': tid, 'positions': [int(pos)]})
-            sp.playlist_remove_specific_occurrences_of_items(
-            SPOTIFY_PLAYLIST_URI, track_ids
+    #remove from the end of the playlist backwards so positions of the
+    #earlier batches stay valid against each new snapshot
+    try:
+        while requested:
+            batch = requested[-MAX_PLAYLIST_BATCH:]
+            track_ids = [{'uri': track.uri, 'positions': [pos]} for pos, track in batch]
+            result = await ch.sp.playlist_remove_specific_occurrences_of_items(
+                ch.playlist_uri, track_ids, snapshot_id
             )
-            status('Removing track', tid)
-            time.sleep(0.3)
-            i+=1
+            snapshot_id = result['snapshot_id']
+            for pos, track in reversed(batch):
+                playlist_tracks.pop(pos)
+            del requested[-MAX_PLAYLIST_BATCH:]
+            status('Removed', len(batch), 'track(s)')
+    except Exception as r:
+        status('Error removing requested songs from playlist.', str(r))
+    playlist_tracks.snapshot_id = snapshot_id
+    save_playlist(ch, 0)
+
+    if ch.now_playing:
+        ch.now_playing.invalidate()
 
 
 #bot will reply with how much credit tipper has
 async def credit_command(cmd: ChatCommand):
     if DISABLE_CREDIT_CMD: return
+    ch = channel_of(cmd)
+    if not ch: return
     
     username = cmd.user.name
-    credit = 0
-    if username.lower() in tippers.keys():
-        credit = tippers[username.lower()]
+    credit = ch.tippers.get(username)
 
-    await cmd.reply(env.from_string(CREDIT_MESSAGE).render(username=username,credit=credit))
+    sender.put(partial(cmd.reply, ch.render('credit', username=username, credit=credit)), PRIORITY_REPLY)
 
 #bot will reply with currently playing song
 async def song_command(cmd: ChatCommand):
 
     if DISABLE_SONG_CMD: return
+    ch = channel_of(cmd)
+    if not ch: return
+
+    #chat comes up before Spotify may be ready, wait instead of dropping it
+    await ch.spotify_ready.wait()
+    if not ch.now_playing: return
 
-    tr = sp.currently_playing()
+    tr = await ch.now_playing.get()
 
     username = cmd.user.name
 
     if tr == None:
-        await cmd.reply(env.from_string(NO_SONG_MESSAGE).render(username=username))
+        sender.put(partial(cmd.reply, ch.render('no_song', username=username)), PRIORITY_SONG)
         return
 
     name = tr['item']['name']
     artist = tr['item']['artists'][0]['name']
 
-    await cmd.reply(env.from_string(SONG_MESSAGE).\
-        render(username=username,name=name,artist=artist))
+    sender.put(partial(cmd.reply, ch.render('song', username=username, name=name, artist=artist)), PRIORITY_SONG)
 
 #bot will add song to playlist if tipper has credit
 async def request_command(cmd: ChatCommand):
 
     if DISABLE_REQUEST_CMD: return
+    ch = channel_of(cmd)
+    if not ch: return
+    tippers = ch.tippers
 
-    if cmd.user.name.lower() in tippers.keys():
-        if tippers[cmd.user.name.lower()] >= 1:
-
-            tr = sp.currently_playing()
-
-            if tr == None:
-                status('Song cannot be added because there is no song from the playlist in the queue.')
-                return
-   
-            tippers[cmd.user.name.lower()] -= 1
-
-            ci = 0
-
-            for track in playlist_tracks:
-                ci += 1
-                if track['track']['id'] == tr['item']['id']:
-                    break
-            
-            for idx, track in enumerate(playlist_tracks):
-                if idx >= ci and track['track']['requested']:
-                    ci += 1
-
-            results = sp.search(q=cmd.parameter, limit=1)
-            track_uris = []
-            for idx, track in enumerate(results['tracks']['items']):
-                track_uris.append(track['uri'])
-
-                nt = {}
-                nt['uri'] = track['uri']
-                nt['requested'] = True
-                nt['id'] = track['id']
-                nt['pos'] = ci
-                playlist_tracks.insert(ci, {'track': nt})
-
-                name = track['name']
-                artist = track['artists'][0]['name']
-                username = cmd.user.name
-
-                await cmd.reply(env.from_string(REQUEST_MESSAGE).\
-                    render(name=name,artist=artist,username=username))
-
-                status(username, 'added', name, 'by', artist, 'to position', str(ci+1), 'in the playlist.')
+    #hold the credit now, so a second request racing this one can't spend it too
+    username = cmd.user.name
+    reservation = tippers.reserve(username)
+    if not reservation: return
 
-            sp.playlist_add_items(SPOTIFY_PLAYLIST_URI, track_uris,ci)
+    try:
+        await ch.playlist_ready.wait()
+        if not ch.now_playing: return
+
+        tr = await ch.now_playing.get()
+
+        if tr == None:
+            status('Song cannot be added because there is no song from the playlist in the queue.')
+            return
+
+        #the credit is only spent once the song is in the playlist
+        try:
+            #songs already in the playlist or requested before are found locally
+            track = track_index.match(cmd.parameter)
+            if track is None:
+                track = await search_cache.search(cmd.parameter)
+                if track is None:
+                    status('No song found for', repr(cmd.parameter) + '.')
+                    return
+                track_index.add(track)
+
+            name = track['name']
+            artist = track['artist']
+
+            #a refresh may have started while searching
+            await ch.playlist_ready.wait()
+            if not ch.batcher: return
+
+            #goes after the current track and any requests queued behind it,
+            #together with whatever else was requested in the same moment
+            ci = await ch.batcher.add(track, tr['item']['id'])
+        except Exception as r:
+            status('Error adding', repr(cmd.parameter), 'to the playlist.', str(r))
+            return
+        tippers.commit(reservation, 'request')
+    finally:
+        if tippers.refund(reservation):
+            status('Kept the credit of', username, 'for the failed request.')
+
+    save_playlist(ch)
+    ch.now_playing.invalidate()
+
+    sender.put(partial(cmd.reply, ch.render('request', name=name, artist=artist, username=username)),
+            PRIORITY_REPLY)
+
+    status(username, 'added', name, 'by', artist, 'to position', str(ci+1), 'in the playlist of', ch.name + '.')
 
 def request_start():
     global DISABLE_REQUEST_CMD
@@ -572,22 +753,123 @@ def request_stop():
     DISABLE_CREDIT_CMD = True
     status('Requests are disabled.')
 
-async def authenticate():
-    global sp
-    twitch = None
+#run a startup stage and remember how long it took
+async def timed(name, coro):
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        startup_timings[name] = time.perf_counter() - start
+
+def timing_report():
+    return ', '.join('%s %.2fs' % (name, t) for name, t in startup_timings.items())
+
+def spotify_auth(ch):
+    scope = 'user-read-currently-playing user-library-read \
+            playlist-modify-private playlist-modify-public'
+    return SpotifyOAuth(
+        client_id=ch.client_id,
+        client_secret=ch.secret,
+        redirect_uri=SPOTIFY_REQUEST_URI,
+        scope=scope,
+        cache_handler=PrivateCacheFileHandler(cache_path=ch.token_file)
+        )
+
+async def authenticate_spotify(ch):
     try:
-        status('Authenticating with Spotify...')
-        scope = 'user-read-currently-playing user-library-read \
-                playlist-modify-private playlist-modify-public'
-        sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-            client_id=SPOTIFY_CLIENT_ID,
-            client_secret=SPOTIFY_SECRET,
-            redirect_uri=SPOTIFY_REQUEST_URI,
-            scope=scope
-            ))
+        status('Authenticating with Spotify for', ch.name + '...')
+        auth = spotify_auth(ch)
+        ch.sp = AsyncSpotify(auth_manager=auth)
+        #first token fetch runs the oauth handshake unless a token is stored.
+        #the handshake listens on SPOTIFY_REQUEST_URI and the browser logs in
+        #whichever account it is signed in to, so channels take turns
+        if auth.cache_handler.get_cached_token():
+            await ch.sp.get_token()
+        else:
+            async with spotify_login:
+                status('Log in to Spotify with the account of', ch.name + '.')
+                await ch.sp.get_token()
+        ch.sp.start_refresh()
+        ch.now_playing = NowPlaying(ch.sp)
+        ch.now_playing.start()
+        ch.batcher = RequestBatcher(ch.sp, ch.playlist_uri, lambda: ch.playlist_tracks,
+                max_batch=MAX_PLAYLIST_BATCH)
+        #searches aren't tied to an account, any channel's client will do
+        if search_cache.sp is None:
+            search_cache.sp = ch.sp
     except Exception as r:
-        return fail('Error connecting to Spotify.', str(r))
-    
+        ch.sp = None
+        ch.now_playing = None
+        ch.playlist_ready.set()
+        return fail('Error connecting to Spotify for', ch.name + '.', str(r))
+    finally:
+        ch.spotify_ready.set()
+
+    #the playlist cache only needs Spotify, chat can take commands meanwhile
+    async def cache():
+        try:
+            await timed('playlist ' + ch.name, cache_playlist(ch))
+            status('Playlist of', ch.name, 'ready in %.2fs.' % startup_timings['playlist ' + ch.name])
+        finally:
+            ch.playlist_ready.set()
+
+    ch.playlist_task = asyncio.ensure_future(cache())
+
+async def authenticate_twitch(join_chat = True):
+    global twitch
+    try:
+        status('Authenticating with Twitch...')
+        twitch_scope = [AuthScope.CHAT_READ, AuthScope.CHAT_EDIT]
+        twitch = await Twitch(TWITCH_CLIENT_ID, TWITCH_SECRET)
+
+        #only runs the oauth flow when there is no usable stored token
+        async def twitch_auth(twitch, scope):
+            if not BOPBOT_WEB:
+                auth = UserAuthenticator(twitch, scope)
+            else:
+                auth = UserAuthenticator_custom(twitch, scope)
+            return await auth.authenticate()
+
+        helper = UserAuthenticationStorageHelper_custom(twitch, twitch_scope,
+                storage_path=TWITCH_TOKEN_FILE, auth_generator_func=twitch_auth)
+        await helper.bind()
+    except Exception as r:
+        return fail('Error connecting to Twitch.', str(r))
+
+    if join_chat:
+        return await timed('chat', start_chat())
+
+async def start_chat():
+    global chat
+    global sender
+    try:
+        #run the chat callbacks on our loop so they share the Spotify session
+        chat = await Chat(twitch, callback_loop=asyncio.get_running_loop())
+        chat.register_event(ChatEvent.READY, on_ready)
+        chat.register_event(ChatEvent.MESSAGE, on_message)
+        chat.register_command(REQUEST_CMD, request_command)
+        chat.register_command(SONG_CMD, song_command)
+        chat.register_command(CREDIT_CMD, credit_command)
+
+        #twitch allows moderators five times as many messages
+        sender = ChatSender(MOD_LIMIT if BOT_MODERATOR else USER_LIMIT)
+        sender.start()
+
+        chat.start()
+    except Exception as r:
+        return fail('Error enterting chat and registering commands.', str(r))
+
+    await room_join(list(channels))
+
+#https://open.spotify.com/playlist/<id>?si=... -> <id>
+def playlist_uri(url):
+    r = re.match('https://open.spotify.com/playlist/(.*)\?si=(.*)', url)
+    if r:
+        return r.groups()[0]
+    return None
+
+def resolve_playlist_url():
+
     global SPOTIFY_PLAYLIST_URL
     global SPOTIFY_PLAYLIST_URI
 
@@ -595,6 +877,7 @@ async def authenticate():
 
     if not SPOTIFY_PLAYLIST_URL:
 
+        import pyperclip
         cd = pyperclip.paste()
         r = re.match(rp,cd)
         if r:
@@ -602,17 +885,8 @@ async def authenticate():
             status('Using copied playlist URL:', cd)
             SPOTIFY_PLAYLIST_URL = cd
             SPOTIFY_PLAYLIST_URI = r.groups()[0]
-        else:
-
-            status()
-            pl = input('Playlist URL: ')
-            if pl:
-                SPOTIFY_PLAYLIST_URL = pl
-                r = re.match(rp,pl)
-                if r:
-                    SPOTIFY_PLAYLIST_URI = r.groups()[0]
-                else:
-                    return fail('Invalid playlist URL.')
+            return True
+        return False
     else:
         status()
         status('Using config playlist URL:', SPOTIFY_PLAYLIST_URL)
@@ -620,110 +894,363 @@ async def authenticate():
         if r:
             SPOTIFY_PLAYLIST_URI = r.groups()[0]
         else:
-            return fail('Invalid playlist URL.')
-    status()
-
+            fail('Invalid playlist URL.')
+        return True
 
-    try:
-        status('Authenticating with Twitch...')
-        twitch_scope = [AuthScope.CHAT_READ, AuthScope.CHAT_EDIT]
-        twitch = await Twitch(TWITCH_CLIENT_ID, TWITCH_SECRET)
-        auth = None
-        if not BOPBOT_WEB:
-            auth = UserAuthenticator(twitch, twitch_scope)
-        else:
-            auth = UserAuthenticator_custom(twitch, twitch_scope)
+async def authenticate():
 
-        token, refresh_token = await auth.authenticate()
-        await twitch.set_user_authentication(token, twitch_scope, refresh_token)
-    except Exception as r:
-        return fail('Error connecting to Twitch.', str(r))
+    global SPOTIFY_PLAYLIST_URL
+    global SPOTIFY_PLAYLIST_URI
 
-    global chat
-    try:
-        chat = await Chat(twitch)
-        chat.register_event(ChatEvent.READY, on_ready)
-        chat.register_event(ChatEvent.MESSAGE, on_message)
-        chat.register_command(REQUEST_CMD, request_command)
-        chat.register_command(SONG_CMD, song_command)
-        chat.register_command(CREDIT_CMD, credit_command)
+    #a worker may not serve the primary channel at all
+    channel_main = channels.get(TARGET_CHANNEL.lower())
+    if channel_main:
+        #the playlist url may need the operator, ask before anything runs
+        if not resolve_playlist_url():
+            #nobody answers a worker's prompt
+            if shard is not None:
+                return fail('No playlist URL configured.')
+            status()
+            pl = await prompt('Playlist URL: ')
+            if pl:
+                SPOTIFY_PLAYLIST_URL = pl
+                SPOTIFY_PLAYLIST_URI = playlist_uri(pl)
+                if not SPOTIFY_PLAYLIST_URI:
+                    return fail('Invalid playlist URL.')
+        if error: return error
+        channel_main.playlist_url = SPOTIFY_PLAYLIST_URL
+        channel_main.playlist_uri = SPOTIFY_PLAYLIST_URI
+
+    #partner channels take their playlist from the config only
+    for ch in channels.values():
+        if ch is not channel_main:
+            ch.playlist_uri = playlist_uri(ch.playlist_url)
+            if not ch.playlist_uri:
+                return fail('Invalid playlist URL for', ch.name + '.')
+    status()
 
-        chat.start()
-    except Exception as r:
-        return fail('Error enterting chat and registering commands.', str(r))
-    
-    cache_playlist()
+    #spotify and twitch don't depend on each other, nor do the channels
+    startup_timings.clear()
+    search_cache.sp = None
+    start = time.perf_counter()
+    await asyncio.gather(
+            *(timed('spotify ' + ch.name, authenticate_spotify(ch)) for ch in channels.values()),
+            timed('twitch', authenticate_twitch()))
+    startup_timings['startup'] = time.perf_counter() - start
+    status('Startup timings:', timing_report())
 
     return twitch
 
+#commands the supervisor runs itself, everything else goes to the workers
+SUPERVISOR_COMMANDS = (b'quit', b'exit', b'help', b'source', b'channel', b'shards', b'workers')
+#commands about the selected channel, only its worker gets them
+CHANNEL_COMMANDS = (b'give', b'tippers', b'playlist', b'spotify')
+
+def forward_command(line):
+    cmd = line.split()[0]
+    result = {'cmd': cmd, 'ok': True}
+    if cmd.encode('utf-8') in CHANNEL_COMMANDS:
+        result['ok'] = supervisor.send(channel.name, line)
+        if not result['ok']:
+            status('No worker is serving', channel.name + '.')
+    else:
+        result['workers'] = supervisor.broadcast(line)
+    return result
+
 async def run_command(line):
 
-    global tippers
-    global playlist_tracks
+    global channel
     global quit
+    global handoff
+
+    if supervisor and not line.split()[0].encode('utf-8') in SUPERVISOR_COMMANDS:
+        return forward_command(line.strip())
 
     line = line.split()
     cmd = line[0].encode('utf-8')
+    result = {'cmd': line[0], 'ok': True}
 
     #commands that can be used while there is an error
     if cmd == b'reset':
+        paused = list(channels.values())
+        for ch in paused:
+            await pause_requests(ch)
+
         status('Clearing tippers list...')
-        tippers = {}
-        
-        clean_playlist()
+        for ch in paused:
+            if ch.tippers:
+                ch.tippers.clear()
+            await clean_playlist(ch)
 
         status('Clearing playlist cache...')
-        playlist_tracks = []
-
-        await run()
+        for ch in paused:
+            ch.playlist_tracks = PlaylistIndex()
+
+        await disconnect()
+        await connect()
+        #requests still waiting on the old channels give up their credit
+        for ch in paused:
+            ch.playlist_ready.set()
+        result['tracks'] = len(channel.playlist_tracks)
         
-    if cmd == b'refresh':
-        clean_playlist()
-        status('Clearing playlist cache...')
-        playlist_tracks = []
-
-        cache_playlist()
+    elif cmd == b'refresh':
+        for ch in channels.values():
+            if not ch.sp: continue
+            await pause_requests(ch)
+            try:
+                await clean_playlist(ch)
+                status('Clearing playlist cache...')
+                ch.playlist_tracks = PlaylistIndex()
+
+                await cache_playlist(ch)
+            finally:
+                ch.playlist_ready.set()
+        result['tracks'] = len(channel.playlist_tracks)
     
-    if cmd == b'quit' or cmd == b'exit' and not BOPBOT_WEB:
+    elif cmd == b'quit' or cmd == b'exit' and not BOPBOT_WEB:
+            quit = True
+            quit_event.set()
+
+    #the worker taking over the channels keeps using the playlist
+    elif cmd == b'handoff' and shard is not None:
+            handoff = True
             quit = True
+            quit_event.set()
+
+    elif cmd == b'shards':
+        if supervisor:
+            result['shards'] = supervisor.stats()
+            for s in result['shards']:
+                status('Worker', s['id'], 'running' if s['alive'] else 'stopped', '-',
+                        ', '.join(s['channels']) + ',', s['restarts'], 'restart(s).')
+        else:
+            result['ok'] = False
+            status('The "shards" command only works when started with --workers.')
+
+    elif cmd == b'workers':
+        if not supervisor:
+            result['ok'] = False
+            status('The "workers" command only works when started with --workers.')
+        elif len(line) >= 2 and line[1].isdigit():
+            await supervisor.scale(int(line[1]))
+            result['workers'] = supervisor.size
+            status('Running', supervisor.size, 'worker(s).')
+        else:
+            result['ok'] = False
+            status('No <count> specified.')
     
     #commands that cannot be used if there is an error
-    if not error:
+    elif error:
+        result['ok'] = False
 
-        if cmd == b'help' and not BOPBOT_WEB:
-            if len(line) >= 2:
-                help(line[1])
-            else:
-                help()
+    elif cmd == b'help' and not BOPBOT_WEB:
+        if len(line) >= 2:
+            help(line[1])
+        else:
+            help()
 
-        if cmd == b'give':
-            if len(line) >= 2:
-                give(line[1])
+    elif cmd == b'channel':
+        if len(line) >= 2:
+            if line[1].lower() in channels:
+                channel = channels[line[1].lower()]
             else:
-                status('No <username> specified.')
-        
-        if cmd == b'tippers':
-            pprint(tippers)
-        
-        if cmd == b'playlist':
-            pprint(playlist_tracks)
-        
-        if cmd == b'start':
-            request_start()
-        
-        if cmd == b'stop':
-            request_stop()
+                result['ok'] = False
+                status('Unknown channel:', line[1])
+        result['channel'] = channel.name
+        result['channels'] = [ch.name for ch in channels.values()]
+        status('Working on', channel.name + '. Channels:', ', '.join(result['channels']))
+
+    elif cmd == b'give':
+        if len(line) >= 2:
+            for username in line[1:]:
+                give(username)
+            result['tippers'] = {u.lower(): channel.tippers.get(u) for u in line[1:]}
+        else:
+            result['ok'] = False
+            status('No <username> specified.')
+    
+    elif cmd == b'source':
+        if len(line) >= 2:
+            await run_script(line[1])
+        else:
+            result['ok'] = False
+            status('No <file> specified.')
 
-    return b''
+    elif cmd == b'tippers':
+        if not BOPBOT_WEB:
+            pprint(dict(channel.tippers.items()))
+        result['tippers'] = dict(channel.tippers.items())
+    
+    elif cmd == b'playlist':
+        if not BOPBOT_WEB:
+            pprint(list(channel.playlist_tracks))
+        result['tracks'] = len(channel.playlist_tracks)
+        result['requested'] = [(pos, track.uri) for pos, track in channel.playlist_tracks.requested()]
+    
+    elif cmd == b'spotify':
+        sp = channel.sp
+        if sp:
+            result['spotify'] = {'circuit': sp.breaker.state, 'failures': sp.breaker.failures,
+                    'retries': sp.retries}
+            status('Spotify circuit is', sp.breaker.state + ',', sp.retries, 'call(s) retried.')
+
+    elif cmd == b'cache':
+        stats = track_index.stats()
+        result['local'] = stats
+        status('Local index:', stats['size'], 'tracks,', '%.0f%%' % (stats['hit_rate'] * 100), 'hit rate.')
+        stats = search_cache.stats()
+        result['search'] = stats
+        status('Search cache:', stats['size'], 'entries,', '%.0f%%' % (stats['hit_rate'] * 100),
+                'hit rate,', stats['evictions'], 'evicted,', stats['expirations'], 'expired.')
+
+    elif cmd == b'timings':
+        result['timings'] = dict(startup_timings, imports=import_time)
+        status('Startup timings:', timing_report(), '- imports %.2fs' % import_time)
+
+    elif cmd == b'start':
+        request_start()
+        result['requests'] = True
+    
+    elif cmd == b'stop':
+        request_stop()
+        result['requests'] = False
 
-#set up twitch and spotify interface and main program loop
-async def run():
+    else:
+        result['ok'] = False
+        status('Unknown command:', line[0])
 
-    global tippers
-    global playlist_tracks
-    
+    if error:
+        result['ok'] = False
+        result['error'] = error
+    return result
+
+#run the commands of a script file, one per line
+async def run_script(path):
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except Exception as r:
+        status('Error reading script', path + '.', str(r))
+        return
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            await run_command(line)
+
+#read stdin on a thread so the loop keeps running while waiting for input
+def start_console():
+
+    global console
+    if console: return
+
+    loop = asyncio.get_running_loop()
+    console = asyncio.Queue()
+
+    def reader():
+        for line in sys.stdin:
+            loop.call_soon_threadsafe(console.put_nowait, line)
+        loop.call_soon_threadsafe(console.put_nowait, None)
+
+    threading.Thread(target=reader, name='console', daemon=True).start()
+
+async def prompt(text = ''):
+    status_writer.flush()
+    if console:
+        print(text, end='', flush=True)
+        line = await console.get()
+        return (line or '').strip()
+    return await asyncio.get_running_loop().run_in_executor(None, input, text)
+
+#read the config, set up twitch and spotify and join the channel
+async def connect():
+
+    global ledger
+    global error
+
+    error = None
     read_conf()
 
+    if not ledger:
+        loop = asyncio.get_running_loop()
+        ledger = CreditLedger(DATABASE, on_error=lambda e: loop.call_soon_threadsafe(status,
+                'Error saving credits, will try again.', str(e)))
+        #workers serving other channels search through the same database
+        search_cache.store = SearchStore(DATABASE)
+    #one ledger for every channel, the balances are kept per channel
+    for ch in channels.values():
+        ch.tippers = CreditStore(ledger, ch.name)
+
+    await authenticate()
+
+async def disconnect():
+
+    global chat
+    global twitch
+
+    chat_ready.clear()
+    for ch in channels.values():
+        if ch.playlist_task:
+            await ch.playlist_task
+        if ch.batcher:
+            await ch.batcher.close()
+        if ch.now_playing:
+            await ch.now_playing.stop()
+            ch.now_playing = None
+    if sender:
+        await sender.stop()
+    if chat:
+        chat.stop()
+        chat = None
+    if twitch:
+        await twitch.close()
+        twitch = None
+    for ch in channels.values():
+        await flush_playlist(ch)
+        if ch.sp:
+            await ch.sp.close()
+            ch.sp = None
+
+#run the channels in worker processes instead of serving them here
+async def start_supervisor(workers):
+
+    global supervisor
+    global error
+    global twitch
+
+    error = None
+    if read_conf(): return error
+
+    #the workers can't all run the oauth handshakes on the same ports,
+    #log in here once so every worker finds the tokens stored
+    await authenticate_twitch(join_chat = False)
+    if twitch:
+        await twitch.close()
+        twitch = None
+    if error: return error
+    loop = asyncio.get_running_loop()
+    for ch in channels.values():
+        auth = spotify_auth(ch)
+        if auth.cache_handler.get_cached_token(): continue
+        status('Log in to Spotify with the account of', ch.name + '.')
+        try:
+            await loop.run_in_executor(None, partial(auth.get_access_token, as_dict=False))
+        except Exception as r:
+            return fail('Error connecting to Spotify for', ch.name + '.', str(r))
+
+    from supervisor import Supervisor
+    supervisor = Supervisor([ch.name for ch in channels.values()], workers,
+            lambda worker, line: status('[' + str(worker.id) + ']', line))
+    await supervisor.start()
+    status('Started', supervisor.size, 'worker(s) for', len(channels), 'channel(s).')
+    #scripts given on the command line are forwarded to the workers
+    chat_ready.set()
+
+#set up twitch and spotify interface and main program loop
+async def run(workers = 0):
+
+    global quit
+    global handoff
+
     status()
     status(
 '''
@@ -734,249 +1261,96 @@ async def run():
     status()
 
     status(app_name, 'has started.')
+    status('Imports took %.2fs.' % import_time)
+
+    if workers:
+        await start_supervisor(workers)
+    else:
+        await connect()
 
-    twitch = await authenticate()
-    await room_join(TARGET_CHANNEL)
+    #nobody can correct a worker's error, so it exits with the playlist
+    #left as it is and the supervisor starts it again
+    failed = shard is not None and bool(error)
+    if failed:
+        status('Worker stopping:', str(error))
+        quit = True
+        handoff = True
+
+    #bopbot_web is only known once the config is read, a playlist url
+    #prompt before this reads stdin on its own
+    if not BOPBOT_WEB:
+        start_console()
 
     if BOPBOT_WEB:
-        site = server.Site(root)
-        reactor.listenTCP(8080, site)
-        reactor.startRunning(False)
+        await timed('web', start_web())
 
     while not quit:
 
         if BOPBOT_WEB:
-            reactor.iterate()
+            await quit_event.wait()
         else:
-            line = input()
+            line = await console.get()
+            if line is None:
+                break
             if len(line.split()) >= 1:
                 if error:
                     status('Error requires correction:', str(error))
                 await run_command(line)
 
-    status('Leaving Twitch...')
-    chat.stop()
-    await twitch.close()
+    await stop_web()
 
-    clean_playlist()
+    if supervisor:
+        status('Stopping workers...')
+        await supervisor.stop()
+    else:
+        for ch in channels.values():
+            if ch.batcher:
+                await ch.batcher.close()
+            if not handoff:
+                await clean_playlist(ch)
+
+        status('Leaving Twitch...')
+        await disconnect()
+        if ledger:
+            ledger.flush()
+            if ledger.pending:
+                status('Could not save', ledger.pending, 'credit change(s).', str(ledger.error))
 
     status('Exiting...')
-
-template = dict(
-    header = dict(title=app_name),
-    content = {},
-    footer = {},
-)
-
-def show_content(tmp):
-
-    header = env.get_template('header.html')
-    content = env.get_template(tmp)
-    footer = env.get_template('footer.html')
-
-    data = header.render(**template['header'])
-    data += content.render(**template['content'])
-    data += footer.render(**template['footer'])
-
-    return data.encode('utf-8')
-
-def custom402(request):
-    request.setHeader('Content-Type', 'text/html; charset=utf-8')
-    request.setResponseCode(402)
-    template['header']['title'] = app_name + ' - Not Authorized'
-    template['content']['message'] = markdown('#Not Authorized\n\nThe page requires authorization.')
-    return show_content('message.html')
-
-def needs_auth(session):
-    if session.uid in auth_sessions:
-        return False
-    return True
-
-class connect(resource.Resource):
-    isLeaf = True
-    def render_GET(self, request):
-        if needs_auth(request.getSession()): return custom402(request)
-        request.setHeader('Content-Type', 'text/html; charset=utf-8')
-        template['header']['title'] = app_name + ' - start'
-        return show_content('start.html')
-
-def configure_get(request):
-    request.setHeader('Content-Type', 'text/html; charset=utf-8')
-    template['header']['title']  = app_name + ' - configure'
-
-    template['content']['BOPBOT_WEB'] = BOPBOT_WEB 
-    template['content']['TWITCH_CLIENT_ID'] = TWITCH_CLIENT_ID
-    template['content']['TWITCH_SECRET'] = TWITCH_SECRET
-    template['content']['TARGET_CHANNEL'] = TARGET_CHANNEL
-    template['content']['SPOTIFY_CLIENT_ID'] = SPOTIFY_CLIENT_ID
-    template['content']['SPOTIFY_SECRET'] = SPOTIFY_SECRET
-    template['content']['SPOTIFY_PLAYLIST_URL'] = SPOTIFY_PLAYLIST_URL
-    template['content']['SPOTIFY_PLAYLIST_URI'] = SPOTIFY_PLAYLIST_URI
-    template['content']['SPOTIFY_REQUEST_URI'] = SPOTIFY_REQUEST_URI
-    template['content']['GIFTED_REGEX'] = GIFTED_REGEX
-    template['content']['BITS_REGEX'] = BITS_REGEX
-    template['content']['TIP_REGEX'] = TIP_REGEX
-    template['content']['SIGNAL_BOT'] = SIGNAL_BOT
-    template['content']['TWITCH_REQUEST_URI'] = TWITCH_REQUEST_URI
-    template['content']['AMOUNT_BITS'] = AMOUNT_BITS
-    template['content']['AMOUNT_GIFTED_TIER1'] = AMOUNT_GIFTED_TIER1
-    template['content']['AMOUNT_GIFTED_TIER2'] = AMOUNT_GIFTED_TIER2
-    template['content']['AMOUNT_GIFTED_TIER3'] = AMOUNT_GIFTED_TIER3
-    template['content']['AMOUNT_TIP'] = AMOUNT_TIP
-    template['content']['REQUEST_CMD'] = REQUEST_CMD
-    template['content']['SONG_CMD'] = SONG_CMD
-    template['content']['CREDIT_CMD'] = CREDIT_CMD
-
-    template['content']['CLEAN_PLAYLIST'] = ''
-    template['content']['DISABLE_CREDIT_CMD'] = ''
-    template['content']['DISABLE_SONG_CMD'] = ''
-    template['content']['DISABLE_REQUEST_CMD'] = ''
-    template['content']['CUMULATIVE_CREDIT'] = ''
-
-    ch = 'checked'
-    if CLEAN_PLAYLIST:
-        template['content']['CLEAN_PLAYLIST'] = ch
-    if DISABLE_CREDIT_CMD:
-        template['content']['DISABLE_CREDIT_CMD'] = ch
-    if DISABLE_SONG_CMD:
-        template['content']['DISABLE_SONG_CMD'] = ch
-    if DISABLE_REQUEST_CMD:
-        template['content']['DISABLE_REQUEST_CMD'] = ch
-    if CUMULATIVE_CREDIT:
-        template['content']['CUMULATIVE_CREDIT'] = ch
-
-    template['content']['CREDIT_MESSAGE'] = CREDIT_MESSAGE
-    template['content']['SONG_MESSAGE'] = SONG_MESSAGE
-    template['content']['NO_SONG_MESSAGE'] = NO_SONG_MESSAGE
-    template['content']['REQUEST_MESSAGE'] = REQUEST_MESSAGE
-    template['content']['NOTIFY_MESSAGE'] = NOTIFY_MESSAGE
-
-    return show_content('configure.html')
-
-def configure_post(request):
-    save_conf(request)
-
-class configure(resource.Resource):
-    isLeaf = True
-    def render_GET(self, request):
-        if needs_auth(request.getSession()): return custom402(request)
-        return configure_get(request)
-
-    def render_POST(self, request):
-        if needs_auth(request.getSession()): return custom402(request)
-
-        configure_post(request)
-
-        return configure_get(request)
-    
-class login(resource.Resource):
-    isLeaf = True
-    def render_GET(self, request):
-        request.setHeader('Content-Type', 'text/html; charset=utf-8')
-        template['header']['title'] = app_name + ' - login'
-        return show_content('login.html')
-    def render_POST(self, request):
-        
-        username = request.args[b'username'][0].decode('utf-8')
-        password = request.args[b'password'][0].decode('utf-8')
-
-        username = html.escape(username)
-        password = html.escape(password)
-
-        salt = ''
-        hashed_pass = ''
-        passwd = json.loads(open('passwd.json').read())
-
-        if username in passwd.keys():
-            salt = passwd[username]['salt']
-            hashed_pass = passwd[username]['pass'].encode('utf-8')
-        else:
-            return custom402(request)
-        
-        test = password + salt
-        test_hash = bcrypt.hashpw(test.encode('utf-8'), salt.encode('utf-8'))
-
-        if hashed_pass == test_hash:
-            global auth_sessions
-            if not request.getSession().uid in auth_sessions:
-                auth_sessions.append(request.getSession().uid)
-            return redirectTo(b'/app/connect', request)
-
-        return custom402(request)
-
-class logout(resource.Resource):
-    isLeaf = True
-    def render_GET(self, request):
-        if needs_auth(request.getSession()): return custom402(request)
-        global auth_sessions
-        if request.getSession().uid in auth_sessions:
-            auth_sessions.remove(request.getSession().uid)
-        request.getSession().expire()
-        request.setHeader('Content-Type', 'text/html; charset=utf-8')
-        template['header']['title'] = app_name + ' - logout'
-        template['content']['message'] = 'You are now logged out.'
-        return show_content('message.html')
-
-class main(resource.Resource):
-    isLeaf = True
-    def render_GET(self, request):
-        request.setHeader('Content-Type', 'text/html; charset=utf-8')
-        template['header']['title'] = app_name
-        template['content']['message'] = markdown(open('README.md').read(),\
-                extensions=['extra','codehilite'], output_format='html5')
-        return show_content('message.html')
-
-class api(resource.Resource):
-    isLeaf = True
-    def render_GET(self, request):
-        if needs_auth(request.getSession()): return custom402(request)
-        request.setHeader('Content-Type', 'text/html; charset=utf-8')
-        if b'cmd' in request.args:
-            r = run_command(request.args[b'cmd'][0])
-            return r
-        else:
-            return b''
-
-class admin(resource.Resource):
-    isLeaf = True
-    def render_GET(self, request):
-        if needs_auth(request.getSession()): return custom402(request)
-        request.setHeader('Content-Type', 'text/html; charset=utf-8')
-
-        template['header']['title'] = app_name + ' - admin'
-        return show_content('admin.html')
-
-class custom404(resource.Resource):
-    isLeaf = True
-    def render_GET(self, request):
-        request.setHeader('Content-Type', 'text/html; charset=utf-8')
-        request.setResponseCode(404)
-        template['header']['title'] = app_name + ' - Not Found'
-        template['content']['message'] = markdown('#Not Found\n\nThe page could not be found.')
-        return show_content('message.html')
-
-class _root(resource.Resource):
-    def getChild(self, path, request):
-        return custom404()
-
-class _auth(resource.Resource):
-    def getChild(self, path, request):
-        return custom404()
-
-root = _root()
-root.putChild(b'', main())
-root.putChild(b'static', static.File('./static'))
-app = _root()
-app.putChild(b'connect', connect())
-app.putChild(b'configure', configure())
-app.putChild(b'api', api())
-app.putChild(b'admin', admin())
-root.putChild(b'app', app)
-auth = _root()
-auth.putChild(b'login', login())
-auth.putChild(b'logout', logout())
-root.putChild(b'auth', auth)
-
+    status_writer.close()
+    return 1 if failed else 0
+#the web ui is only imported when bopbot_web is enabled
+async def start_web():
+    global web
+    import web
+    web.bot = sys.modules[__name__]
+    await web.start()
+
+async def stop_web():
+    if web:
+        await web.stop()
+
+async def main(scripts, workers = 0):
+    if scripts:
+        #run command files given on the command line once chat is up
+        async def run_scripts():
+            await chat_ready.wait()
+            for path in scripts:
+                await run_script(path)
+        asyncio.ensure_future(run_scripts())
+    return await run(workers)
 
 if __name__ == '__main__':
-    asyncio.run(run())
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(prog='bopbot')
+    parser.add_argument('scripts', nargs='*', help='command files to run once chat is up')
+    parser.add_argument('--workers', type=int, default=0,
+            help='serve the channels from this many worker processes')
+    parser.add_argument('--shard', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.shard is not None:
+        shard = [name.strip().lower() for name in args.shard.split(',') if name.strip()]
+    #twisted's asyncio reactor needs a selector loop, windows defaults to proactor
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    exit(asyncio.run(main(args.scripts, args.workers)))
\ No newline at end of file
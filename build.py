@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 import PyInstaller.__main__
 import shutil
+import sys
+
+#--onedir skips unpacking the whole bundle to a temp dir on every launch,
+#so the bot starts faster at the cost of shipping a folder
+onedir = '--onedir' in sys.argv[1:]
 
 PyInstaller.__main__.run([
     'bopbot.py',
-    '--onefile'
+    '--onedir' if onedir else '--onefile'
 ])
 
-shutil.copyfile('./config.template.ini','./dist/config.ini')
-shutil.copyfile('./start.bat','./dist/start.bat')
\ No newline at end of file
+dist = './dist/bopbot' if onedir else './dist'
+shutil.copyfile('./config.template.ini', dist + '/config.ini')
+shutil.copyfile('./start.bat', dist + '/start.bat')
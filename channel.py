@@ -0,0 +1,75 @@
+"""
+Channel contexts
+================
+
+A single bot process serves any number of Twitch channels over one chat
+connection. Everything that belongs to one channel lives in a
+:class:`Channel`: the Spotify account and playlist requests go to, the
+playlist index, the credit balances and the reply templates. The chat
+handlers pick the context by the room a message came from.
+
+The primary channel is configured in the ``[twitch]`` and ``[spotify]``
+sections as before; every other channel gets a ``[channel:<name>]`` section
+whose settings fall back to those::
+
+    [channel:partner]
+    playlist_url = https://open.spotify.com/playlist/...?si=...
+    spotify_client_id = ...
+    spotify_secret_key = ...
+    request_message = @{{username}} queued {{name}}!
+"""
+import asyncio
+
+from playlist import PlaylistIndex
+
+__all__ = ['MESSAGES', 'Channel']
+
+MESSAGES = ('credit', 'song', 'no_song', 'request', 'notify', 'notify_batch')
+"""Reply templates, configured as ``<name>_message``"""
+
+
+class Channel:
+    """State of one channel the bot serves.
+
+    :param name: Twitch channel name
+    :param playlist_url: Spotify playlist requests are added to
+    :param client_id: Spotify app client id
+    :param secret: Spotify app secret
+    :param token_file: where the Spotify token of the channel's account is
+        stored
+    :param templates: ``{message: template source}`` overriding the
+        defaults, see :data:`MESSAGES`
+    """
+
+    def __init__(self, name: str, playlist_url: str = '', client_id: str = '', secret: str = '',
+                 token_file: str = 'spotify_token.json', templates: dict = None):
+        self.name = name
+        self.playlist_url = playlist_url
+        self.playlist_uri = ''
+        self.client_id = client_id
+        self.secret = secret
+        self.token_file = token_file
+        self.templates = templates or {}
+        self.messages = {}
+        """Compiled reply templates"""
+        self.tippers = None
+        """:class:`~credits.CreditStore` of the channel"""
+        self.playlist_tracks = PlaylistIndex()
+        self.sp = None
+        self.now_playing = None
+        self.batcher = None
+        self.playlist_save = None
+        self.playlist_dirty = False
+        """Edits not yet written to the playlist cache"""
+        self.playlist_task = None
+        self.spotify_ready = asyncio.Event()
+        self.playlist_ready = asyncio.Event()
+
+    def __repr__(self):
+        return f'Channel({self.name!r})'
+
+    def render(self, message: str, **kwargs) -> str:
+        return self.messages[message].render(**kwargs)
+
+    def cache_path(self) -> str:
+        return './playlist_cache/' + self.playlist_uri + '.json'
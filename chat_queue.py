@@ -0,0 +1,139 @@
+"""
+Outbound chat queue
+===================
+
+Handlers hand their replies to a :class:`ChatSender` and return right away.
+A single sender task delivers them in priority order within Twitch's rate
+limits, so a burst of events can't get the bot throttled and never stalls
+the handlers.
+
+Messages of the same group (e.g. credit notifications for one channel) wait
+a short ``linger`` time and are merged into one line if more arrive in the
+meantime, or while the sender is waiting for the rate limit.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+
+__all__ = ['PRIORITY_NOTIFY', 'PRIORITY_REPLY', 'PRIORITY_SONG',
+           'MOD_LIMIT', 'USER_LIMIT', 'join_names', 'ChatSender']
+
+PRIORITY_NOTIFY = 0
+PRIORITY_REPLY = 1
+PRIORITY_SONG = 2
+
+MOD_LIMIT = 100
+"""Messages per 30 seconds Twitch allows moderators and the broadcaster"""
+USER_LIMIT = 20
+"""Messages per 30 seconds Twitch allows everyone else"""
+
+
+def join_names(names: list) -> str:
+    """``['a', 'b', 'c']`` -> ``'a, b and c'``"""
+    if len(names) < 2:
+        return ''.join(names)
+    return ', '.join(names[:-1]) + ' and ' + names[-1]
+
+
+class ChatSender:
+    """Rate limited, prioritized outbound message queue.
+
+    The token bucket holds at most half of ``limit`` and refills the other
+    half over ``per`` seconds, so no window of ``per`` seconds ever sees more
+    than ``limit`` messages.
+
+    :param limit: messages allowed per ``per`` seconds
+    :param per: length of the rate limit window in seconds
+    :param linger: seconds a group message waits for more to merge
+    """
+
+    def __init__(self, limit: int = USER_LIMIT, per: float = 30.0, linger: float = 1.0):
+        self.capacity = max(1, limit // 2)
+        self.rate = max(limit - self.capacity, 1) / per
+        self.linger = linger
+        self.sent = 0
+        self.merged = 0
+        self._tokens = float(self.capacity)
+        self._stamp = time.monotonic()
+        self._heap = []
+        self._groups = {}
+        self._seq = itertools.count()
+        self._ready = None
+        self._task = None
+
+    def put(self, send, priority: int = PRIORITY_REPLY):
+        """Queue ``send``, a coroutine function without arguments."""
+        heapq.heappush(self._heap, (priority, next(self._seq), send, None))
+        self._wake()
+
+    def put_group(self, key, item, merge, priority: int = PRIORITY_NOTIFY):
+        """Queue ``item`` under ``key``. When the group is sent, ``merge`` is
+        called with all items queued so far and has to return the coroutine
+        function that sends them."""
+        if key in self._groups:
+            self._groups[key][0].append(item)
+            self.merged += 1
+            return
+        self._groups[key] = ([item], merge)
+        entry = (priority, next(self._seq), None, key)
+        asyncio.get_running_loop().call_later(self.linger, self._push, entry)
+
+    def _push(self, entry):
+        heapq.heappush(self._heap, entry)
+        self._wake()
+
+    def _wake(self):
+        if self._ready is not None:
+            self._ready.set()
+
+    def pending(self) -> int:
+        return len(self._heap) + len(self._groups)
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            await self._take_token()
+            priority, seq, send, key = heapq.heappop(self._heap)
+            try:
+                if key is not None:
+                    items, merge = self._groups.pop(key)
+                    send = merge(items)
+                await send()
+                self.sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._ready = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        """Give queued messages up to ``timeout`` seconds, then stop."""
+        if self._task is None:
+            return
+        end = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < end:
+            await asyncio.sleep(0.1)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
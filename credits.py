@@ -0,0 +1,261 @@
+"""
+Credit ledger
+=============
+
+Durable storage for the song request credits of every tipper.
+
+Credits live in an SQLite database in WAL mode. The ``credits`` table holds
+the current balance per channel and user, so loading it at startup is a
+single query no matter how long the bot has been running. Every change is
+also appended to the ``history`` table.
+
+Writes never touch the disk on the caller's thread: :meth:`CreditLedger.record`
+only queues the change, and a writer thread commits everything queued so
+far in one transaction (group commit). A batch that fails to commit is kept
+and tried again with the next one, so a locked or full database doesn't
+lose credits.
+
+:class:`CreditStore` holds the balances of one channel in memory on top of a
+ledger. Spending a credit is split into :meth:`~CreditStore.reserve`, taken
+before a request starts, and :meth:`~CreditStore.commit` or
+:meth:`~CreditStore.refund` once it finished, so concurrent requests can't
+spend the same credit twice.
+"""
+import queue
+import sqlite3
+import threading
+import time
+
+__all__ = ['CreditLedger', 'Reservation', 'CreditStore']
+
+RETRY_DELAY = 5.0
+"""Seconds before a failed batch is committed again if nothing new arrives"""
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS credits (
+    channel TEXT NOT NULL,
+    username TEXT NOT NULL,
+    credit INTEGER NOT NULL,
+    PRIMARY KEY (channel, username)
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    channel TEXT NOT NULL,
+    username TEXT,
+    delta INTEGER NOT NULL,
+    credit INTEGER NOT NULL,
+    reason TEXT
+);
+'''
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    con = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=NORMAL')
+    con.executescript(SCHEMA)
+    return con
+
+
+class CreditLedger:
+    """Write-behind SQLite credit ledger.
+
+    :param path: database file
+    :param max_batch: most changes committed in a single transaction
+    :param on_error: called on the writer thread with the
+        :class:`sqlite3.Error` of every failed commit
+    """
+
+    def __init__(self, path: str = 'bopbot.db', max_batch: int = 1000, on_error=None):
+        self.path = path
+        self.max_batch = max_batch
+        self.on_error = on_error
+        self._queue = queue.SimpleQueue()
+        self.error = None
+        """Error of the last commit, :code:`None` once a commit succeeded"""
+        self.pending = 0
+        """Changes waiting to be committed again"""
+        self._con = _connect(path)
+        self._thread = threading.Thread(target=self._run, name='credit-ledger', daemon=True)
+        self._thread.start()
+
+    def load(self, channel: str) -> dict:
+        """Current balances of ``channel`` as ``{username: credit}``."""
+        self.flush()
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            rows = con.execute('SELECT username, credit FROM credits WHERE channel = ?',
+                    (channel,)).fetchall()
+        finally:
+            con.close()
+        return dict(rows)
+
+    def record(self, channel: str, username: str, credit: int, delta: int, reason: str = ''):
+        """Queue the new balance of ``username`` after a change of ``delta``."""
+        self._queue.put(('set', time.time(), channel, username, credit, delta, reason))
+
+    def clear(self, channel: str, reason: str = 'reset'):
+        """Queue removing every balance of ``channel``."""
+        self._queue.put(('clear', time.time(), channel, None, 0, 0, reason))
+
+    def flush(self):
+        """Block until everything queued so far is committed, or failed to
+        commit and waits for the next try."""
+        done = threading.Event()
+        self._queue.put(('flush', done))
+        done.wait()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        con = self._con
+        failed = []
+        while True:
+            try:
+                batch = [self._queue.get(timeout=RETRY_DELAY if failed else None)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            waiting = [item[1] for item in batch if item is not None and item[0] == 'flush']
+            stop = None in batch
+            changes = failed + [item for item in batch if item is not None and item[0] != 'flush']
+            try:
+                with con:
+                    for item in changes:
+                        self._apply(con, *item)
+                failed = []
+                self.error = None
+            except sqlite3.Error as e:
+                # keep the changes in order, they go first in the next try
+                failed = changes
+                self.error = e
+                if self.on_error:
+                    try:
+                        self.on_error(e)
+                    except Exception:
+                        pass
+            self.pending = len(failed)
+            for done in waiting:
+                done.set()
+            if stop:
+                con.close()
+                return
+
+    @staticmethod
+    def _apply(con, op, when, channel, username, credit, delta, reason):
+        if op == 'set':
+            con.execute('INSERT INTO credits (channel, username, credit) VALUES (?, ?, ?) '
+                    'ON CONFLICT (channel, username) DO UPDATE SET credit = excluded.credit',
+                    (channel, username, credit))
+        elif op == 'clear':
+            con.execute('DELETE FROM credits WHERE channel = ?', (channel,))
+        con.execute('INSERT INTO history (time, channel, username, delta, credit, reason) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (when, channel, username, delta, credit, reason))
+
+
+class Reservation:
+    """Credits held for a request until it is committed or refunded."""
+
+    __slots__ = ('username', 'amount', 'generation', 'done')
+
+    def __init__(self, username: str, amount: int, generation: int):
+        self.username = username
+        self.amount = amount
+        self.generation = generation
+        self.done = False
+
+
+class CreditStore:
+    """Balances of one channel, written through to a :class:`CreditLedger`.
+
+    Every method is synchronous and runs on the event loop thread, which is
+    the only writer; a check and the change it guards can't be split by an
+    ``await``, so no locks are needed.
+
+    :param ledger: the ledger changes are recorded in
+    :param channel: channel the balances belong to
+    """
+
+    def __init__(self, ledger: CreditLedger, channel: str):
+        self.ledger = ledger
+        self.channel = channel
+        self._balances = ledger.load(channel)
+        self._held = {}
+        self._generation = 0
+
+    def __contains__(self, username: str):
+        return username.lower() in self._balances
+
+    def get(self, username: str) -> int:
+        """Credits ``username`` can spend right now."""
+        username = username.lower()
+        return self._balances.get(username, 0) - self._held.get(username, 0)
+
+    def items(self):
+        return [(username, self.get(username)) for username in self._balances]
+
+    def _record(self, username: str, credit: int, reason: str):
+        delta = credit - self._balances.get(username, 0)
+        self._balances[username] = credit
+        self.ledger.record(self.channel, username, credit, delta, reason)
+        return credit
+
+    def add(self, username: str, amount: int, reason: str = '') -> int:
+        """Add ``amount`` credits and return the new balance."""
+        username = username.lower()
+        self._record(username, self._balances.get(username, 0) + amount, reason)
+        return self.get(username)
+
+    def set(self, username: str, credit: int, reason: str = '') -> int:
+        username = username.lower()
+        self._record(username, credit + self._held.get(username, 0), reason)
+        return self.get(username)
+
+    def reserve(self, username: str, amount: int = 1):
+        """Hold ``amount`` credits, or return :code:`None` if ``username``
+        can't afford them."""
+        if self.get(username) < amount:
+            return None
+        username = username.lower()
+        self._held[username] = self._held.get(username, 0) + amount
+        return Reservation(username, amount, self._generation)
+
+    def _release(self, reservation: Reservation) -> bool:
+        if reservation.done:
+            return False
+        reservation.done = True
+        if reservation.generation != self._generation:
+            return False
+        held = self._held[reservation.username] - reservation.amount
+        if held:
+            self._held[reservation.username] = held
+        else:
+            del self._held[reservation.username]
+        return True
+
+    def commit(self, reservation: Reservation, reason: str = ''):
+        """Spend the held credits."""
+        if self._release(reservation):
+            username = reservation.username
+            self._record(username, self._balances.get(username, 0) - reservation.amount, reason)
+
+    def refund(self, reservation: Reservation) -> bool:
+        """Give the held credits back; does nothing once committed."""
+        return self._release(reservation)
+
+    def clear(self, reason: str = 'reset'):
+        """Remove every balance; open reservations can no longer be
+        committed."""
+        self._balances.clear()
+        self._held.clear()
+        self._generation += 1
+        self.ledger.clear(self.channel, reason)
@@ -0,0 +1,133 @@
+"""
+Donation parser
+===============
+
+Turns signal bot chat notifications into song request credits, for example
+the Streamlabs lines::
+
+    Thank you username for donating 100 bits
+    username just gifted 1 Tier 1 subscriptions!
+    Thank you username for tipping $1.00!
+
+The patterns of each signal bot are compiled once into a single alternation,
+so a message is classified with one match. The group layout of the configured
+patterns stays the same as before: the first group is the username, the
+second the amount and, for gifted subs, the third the tier.
+
+:data:`SIGNAL_BOTS` has pattern sets for the default chat alerts of
+StreamElements and Fossabot; bots with customized alerts configure their own.
+"""
+import math
+import re
+
+__all__ = ['EVENTS', 'SIGNAL_BOTS', 'Donation', 'DonationParser']
+
+EVENTS = ('tip', 'bits', 'gifted')
+
+_AMOUNT = r'((?:0|[1-9][0-9]*)(?:\.[0-9]{1,2})?)'
+
+SIGNAL_BOTS = {
+    'streamelements': {
+        'tip': r'(\S+) just tipped \$?' + _AMOUNT,
+        'bits': r'(\S+) just cheered ([1-9][0-9]*) bits',
+        'gifted': r'(\S+) just gifted ([1-9][0-9]*) (?:Tier ([1-3]) )?sub',
+    },
+    'fossabot': {
+        'tip': r'(\S+) (?:just )?(?:tipped|donated) \$?' + _AMOUNT,
+        'bits': r'(\S+) (?:just )?cheered ([1-9][0-9]*) bits',
+        'gifted': r'(\S+) (?:just )?gifted ([1-9][0-9]*) (?:Tier ([1-3]) )?sub',
+    },
+}
+"""Built-in ``{event: pattern}`` sets by lowercase signal bot name; the tier
+group of gifted subs is optional, alerts without it count as tier 1"""
+
+
+class Donation:
+    """A parsed donation notification."""
+
+    __slots__ = ('event', 'username', 'amount', 'tier', 'credit')
+
+    def __init__(self, event: str, username: str, amount: float, tier, credit: int):
+        self.event = event
+        self.username = username
+        self.amount = amount
+        self.tier = tier
+        self.credit = credit
+        """Credits earned, 0 if the amount is below the cost"""
+
+    def __repr__(self):
+        return f'Donation({self.event!r}, {self.username!r}, {self.amount}, credit={self.credit})'
+
+
+class _Matcher:
+    """All patterns of one signal bot, matched in a single pass."""
+
+    def __init__(self, patterns: dict):
+        self.patterns = [(event, re.compile(p)) for event, p in patterns.items() if p]
+        alternatives = '|'.join(f'(?P<{event}>{p.pattern})' for event, p in self.patterns)
+        try:
+            self.combined = re.compile(alternatives) if self.patterns else None
+        except re.error:
+            # patterns with clashing named groups cannot be combined
+            self.combined = None
+
+    def match(self, text: str):
+        """Return ``(event, groups)`` for the first pattern matching ``text``."""
+        if self.combined:
+            m = self.combined.match(text)
+            if not m:
+                return None
+            event = m.lastgroup
+            start = m.re.groupindex[event]
+            size = dict(self.patterns)[event].groups
+            return event, m.groups()[start:start + size]
+        for event, pattern in self.patterns:
+            m = pattern.match(text)
+            if m:
+                return event, m.groups()
+        return None
+
+
+class DonationParser:
+    """Classifies signal bot messages and prices them in credits.
+
+    :param bots: ``{signal bot name: {event: pattern}}``
+    :param costs: ``{(event, tier): amount per credit}``, tier is :code:`None`
+        for tips and bits
+    :param cumulative: if :code:`False` any donation above the cost is worth
+        exactly one credit
+    """
+
+    def __init__(self, bots: dict, costs: dict, cumulative: bool = True):
+        self.matchers = {name.lower(): _Matcher(patterns) for name, patterns in bots.items()}
+        self.costs = costs
+        self.cumulative = cumulative
+
+    def is_signal_bot(self, username: str) -> bool:
+        return username.lower() in self.matchers
+
+    def parse(self, username: str, text: str):
+        """Return a :class:`Donation` if ``username`` is a signal bot and
+        ``text`` one of its notifications, otherwise :code:`None`."""
+        matcher = self.matchers.get(username.lower())
+        if matcher is None:
+            return None
+        result = matcher.match(text)
+        if result is None:
+            return None
+        event, groups = result
+        try:
+            tipper = groups[0]
+            amount = float(groups[1])
+            tier = None
+            if event == 'gifted':
+                tier = int(groups[2] or 1)
+        except (IndexError, TypeError, ValueError):
+            return None
+
+        cost = self.costs.get((event, tier))
+        credit = 0
+        if cost and amount >= cost:
+            #TODO currency conversion
+            credit = math.floor(amount / cost) if self.cumulative else 1
+        return Donation(event, tipper, amount, tier, credit)
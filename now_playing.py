@@ -0,0 +1,112 @@
+"""
+Now-playing tracker
+===================
+
+Keeps the answer of ``currently_playing`` in memory so chat commands do not
+have to ask Spotify every time. The tracker polls once, predicts when the
+track will change from ``progress_ms`` and ``duration_ms`` and only polls
+again close to that boundary, after :meth:`NowPlaying.invalidate` (e.g. a
+playlist edit) or after ``max_interval`` seconds to notice manual skips.
+"""
+import asyncio
+import time
+
+__all__ = ['NowPlaying']
+
+
+class NowPlaying:
+    """Background tracker for the currently playing Spotify item.
+
+    :param sp: an :class:`~spotify_async.AsyncSpotify` client
+    :param max_interval: longest time in seconds between two polls
+    :param margin: seconds to wait past the predicted end of a track
+    """
+
+    def __init__(self, sp, max_interval: float = 30.0, margin: float = 1.0):
+        self.sp = sp
+        self.max_interval = max_interval
+        self.margin = margin
+        self.current = None
+        """Last ``currently_playing`` response, :code:`None` if nothing plays"""
+        self.polls = 0
+        self.hits = 0
+        self._fetched_at = 0.0
+        self._ends_at = 0.0
+        self._pending = None
+        self._wake = None
+        self._task = None
+
+    def _remaining(self) -> float:
+        tr = self.current
+        if not tr or not tr.get('is_playing') or not tr.get('item'):
+            return self.max_interval
+        duration = tr['item'].get('duration_ms') or 0
+        progress = tr.get('progress_ms') or 0
+        return max(0.0, (duration - progress) / 1000)
+
+    async def _fetch(self):
+        try:
+            self.current = await self.sp.currently_playing()
+        finally:
+            self.polls += 1
+            self._fetched_at = time.monotonic()
+            self._ends_at = self._fetched_at + self._remaining()
+            self._pending = None
+        return self.current
+
+    async def refresh(self):
+        """Poll Spotify now; concurrent callers share one request."""
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._fetch())
+        return await asyncio.shield(self._pending)
+
+    def stale(self) -> bool:
+        return self._fetched_at == 0.0 or time.monotonic() > self._ends_at
+
+    async def get(self):
+        """Return the currently playing item, from memory whenever possible.
+        While Spotify can't be reached the last known item is returned."""
+        if self.stale():
+            try:
+                return await self.refresh()
+            except Exception:
+                return self.current
+        self.hits += 1
+        return self.current
+
+    def invalidate(self):
+        """Force a poll soon, e.g. after the playlist was edited."""
+        self._ends_at = 0.0
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+            delay = self.max_interval
+            if self.current and self.current.get('is_playing'):
+                delay = min(delay, self._ends_at - time.monotonic() + self.margin)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(delay, self.margin))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -443,10 +443,16 @@ class UserAuthenticationStorageHelper_custom:
         auth = UserAuthenticator(twitch, scopes, force_verify=True, auth_base_url=self.auth_base_url)
         return await auth.authenticate()
 
+    def _store_tokens(self, token: str, refresh_token: str):
+        # only the owner may read the tokens
+        fd = os.open(self.storage_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as _f:
+            json.dump({'token': token, 'refresh': refresh_token}, _f)
+        os.chmod(self.storage_path, 0o600)
+
     async def _update_stored_tokens(self, token: str, refresh_token: str):
         self.logger.info('user token got refreshed and stored')
-        with open(self.storage_path, 'w') as _f:
-            json.dump({'token': token, 'refresh': refresh_token}, _f)
+        self._store_tokens(token, refresh_token)
 
     async def bind(self):
         """Bind the helper to the provided instance of twitch and sets the user authentication."""
@@ -456,13 +462,22 @@ class UserAuthenticationStorageHelper_custom:
             try:
                 with open(self.storage_path, 'r') as _f:
                     creds = json.load(_f)
-                await self.twitch.set_user_authentication(creds['token'], self._target_scopes, creds['refresh'])
-            except:
-                self.logger.info('stored token invalid, refreshing...')
+                try:
+                    await self.twitch.set_user_authentication(creds['token'], self._target_scopes, creds['refresh'])
+                except (InvalidRefreshTokenException, UnauthorizedException):
+                    raise
+                except Exception:
+                    # access token expired, the refresh token usually is still good
+                    self.logger.info('stored token invalid, refreshing...')
+                    token, refresh_token = await refresh_access_token(creds['refresh'],
+                            self.twitch.app_id, self.twitch.app_secret, auth_base_url=self.auth_base_url)
+                    self._store_tokens(token, refresh_token)
+                    await self.twitch.set_user_authentication(token, self._target_scopes, refresh_token)
+            except Exception:
+                self.logger.info('stored token unusable, authenticating again...')
             else:
                 needs_auth = False
         if needs_auth:
             token, refresh_token = await self.auth_generator(self.twitch, self._target_scopes)
-            with open(self.storage_path, 'w') as _f:
-                json.dump({'token': token, 'refresh': refresh_token}, _f)
+            self._store_tokens(token, refresh_token)
             await self.twitch.set_user_authentication(token, self._target_scopes, refresh_token)
@@ -0,0 +1,380 @@
+"""
+Playlist index
+==============
+
+In-memory model of the Spotify playlist the bot adds requests to.
+
+Tracks are kept in an implicit treap (a randomized balanced tree ordered by
+playlist position) so looking up a position, inserting and removing are all
+O(log n) instead of shifting a list. Every node also counts the tracks in its
+subtree that were *not* requested, which lets :meth:`PlaylistIndex.next_free`
+jump over a run of requested tracks in O(log n) as well.
+
+:func:`fetch_tracks` loads a whole playlist, fetching every page after the
+first one concurrently. :func:`read_cache` and :func:`write_cache` keep a
+copy on disk, tagged with the playlist ``snapshot_id``, so a restart only
+downloads the playlist again when it actually changed.
+"""
+import asyncio
+import json
+import os
+import random
+
+__all__ = ['Track', 'PlaylistIndex', 'fetch_tracks', 'read_cache', 'write_cache']
+
+PAGE_SIZE = 100
+TRACK_FIELDS = 'items(track(id,uri,name,artists(name))),total'
+
+
+class Track:
+    """A single playlist entry."""
+
+    __slots__ = ('id', 'uri', 'requested', 'name', 'artist')
+
+    def __init__(self, id: str, uri: str, requested: bool = False, name: str = '', artist: str = ''):
+        self.id = id
+        self.uri = uri
+        self.requested = requested
+        self.name = name
+        self.artist = artist
+
+    def __repr__(self):
+        return f'Track({self.id!r}, requested={self.requested})'
+
+
+class _Node:
+    __slots__ = ('track', 'prio', 'size', 'free', 'left', 'right', 'parent')
+
+    def __init__(self, track: Track, prio: float):
+        self.track = track
+        self.prio = prio
+        self.size = 1
+        self.free = 0 if track.requested else 1
+        self.left = None
+        self.right = None
+        self.parent = None
+
+
+def _size(node) -> int:
+    return node.size if node else 0
+
+
+def _free(node) -> int:
+    return node.free if node else 0
+
+
+def _update(node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+    node.free = (0 if node.track.requested else 1) + _free(node.left) + _free(node.right)
+    if node.left:
+        node.left.parent = node
+    if node.right:
+        node.right.parent = node
+
+
+def _split(node, k):
+    """Split into (first k nodes, rest)."""
+    if node is None:
+        return None, None
+    if _size(node.left) < k:
+        left, right = _split(node.right, k - _size(node.left) - 1)
+        node.right = left
+        _update(node)
+        if right:
+            right.parent = None
+        return node, right
+    left, right = _split(node.left, k)
+    node.left = right
+    _update(node)
+    if left:
+        left.parent = None
+    return left, node
+
+
+def _merge(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio > b.prio:
+        a.right = _merge(a.right, b)
+        _update(a)
+        return a
+    b.left = _merge(a, b.left)
+    _update(b)
+    return b
+
+
+class PlaylistIndex:
+    """Ordered, indexed view of a playlist.
+
+    :param tracks: initial tracks in playlist order
+    """
+
+    def __init__(self, tracks=()):
+        self._root = None
+        self._ids = {}
+        self.snapshot_id = None
+        """Spotify snapshot the index was last synced with"""
+        self._build(tracks)
+
+    def _build(self, tracks):
+        # Cartesian tree construction over random priorities, O(n)
+        stack = []
+        root = None
+        for track in tracks:
+            node = self._new_node(track)
+            last = None
+            while stack and stack[-1].prio < node.prio:
+                last = stack.pop()
+                _update(last)
+            node.left = last
+            if stack:
+                stack[-1].right = node
+            stack.append(node)
+        while stack:
+            root = stack.pop()
+            _update(root)
+        if root:
+            root.parent = None
+        self._root = root
+
+    def _new_node(self, track: Track) -> _Node:
+        node = _Node(track, random.random())
+        self._ids.setdefault(track.id, []).append(node)
+        return node
+
+    def __len__(self):
+        return _size(self._root)
+
+    def __iter__(self):
+        stack = []
+        node = self._root
+        while stack or node:
+            while node:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.track
+            node = node.right
+
+    def __getitem__(self, pos: int) -> Track:
+        return self._node_at(pos).track
+
+    def __contains__(self, track_id):
+        return track_id in self._ids
+
+    def _node_at(self, pos: int) -> _Node:
+        if pos < 0:
+            pos += len(self)
+        if not 0 <= pos < len(self):
+            raise IndexError('playlist index out of range')
+        node = self._root
+        while True:
+            ls = _size(node.left)
+            if pos < ls:
+                node = node.left
+            elif pos == ls:
+                return node
+            else:
+                pos -= ls + 1
+                node = node.right
+
+    @staticmethod
+    def _rank(node: _Node) -> int:
+        pos = _size(node.left)
+        while node.parent:
+            if node is node.parent.right:
+                pos += _size(node.parent.left) + 1
+            node = node.parent
+        return pos
+
+    def positions(self, track_id: str) -> list:
+        """All positions of ``track_id`` in playlist order."""
+        return sorted(self._rank(n) for n in self._ids.get(track_id, ()))
+
+    def position(self, track: Track) -> int:
+        for node in self._ids.get(track.id, ()):
+            if node.track is track:
+                return self._rank(node)
+        raise ValueError(f'{track!r} is not in the playlist')
+
+    def insert(self, pos: int, track: Track):
+        node = self._new_node(track)
+        left, right = _split(self._root, pos)
+        self._root = _merge(_merge(left, node), right)
+        self._root.parent = None
+
+    def append(self, track: Track):
+        self.insert(len(self), track)
+
+    def pop(self, pos: int) -> Track:
+        node = self._node_at(pos)
+        pos = self._rank(node)
+        left, right = _split(self._root, pos)
+        mid, right = _split(right, 1)
+        self._root = _merge(left, right)
+        if self._root:
+            self._root.parent = None
+        nodes = self._ids[node.track.id]
+        nodes.remove(node)
+        if not nodes:
+            del self._ids[node.track.id]
+        return node.track
+
+    def remove(self, track: Track):
+        self.pop(self.position(track))
+
+    def set_requested(self, track: Track, requested: bool):
+        track.requested = requested
+        for node in self._ids.get(track.id, ()):
+            if node.track is track:
+                while node:
+                    _update(node)
+                    node = node.parent
+
+    def _free_before(self, pos: int) -> int:
+        count = 0
+        node = self._root
+        while node:
+            ls = _size(node.left)
+            if pos <= ls:
+                node = node.left
+            else:
+                count += _free(node.left) + (0 if node.track.requested else 1)
+                pos -= ls + 1
+                node = node.right
+        return count
+
+    def next_free(self, pos: int) -> int:
+        """Position of the first not requested track at or after ``pos``,
+        or the playlist length if there is none."""
+        k = self._free_before(pos)
+        if k >= _free(self._root):
+            return len(self)
+        # descend to the (k+1)-th free node
+        node = self._root
+        base = 0
+        while True:
+            lf = _free(node.left)
+            own = 0 if node.track.requested else 1
+            if k < lf:
+                node = node.left
+            elif k < lf + own:
+                return base + _size(node.left)
+            else:
+                k -= lf + own
+                base += _size(node.left) + 1
+                node = node.right
+
+    def insertion_point(self, current_id: str) -> int:
+        """Where the next request goes: right after the current track and
+        the run of requests already queued behind it."""
+        positions = self.positions(current_id)
+        if not positions:
+            return len(self)
+        return self.next_free(positions[0] + 1)
+
+    def requested(self) -> list:
+        """``(position, track)`` of every requested track in playlist order."""
+        result = []
+
+        def walk(node, base):
+            if node is None or node.free == node.size:
+                return
+            walk(node.left, base)
+            here = base + _size(node.left)
+            if node.track.requested:
+                result.append((here, node.track))
+            walk(node.right, here + 1)
+
+        walk(self._root, 0)
+        return result
+
+    def dump(self) -> dict:
+        """Compact, JSON serializable form of the index."""
+        return {
+            'snapshot_id': self.snapshot_id,
+            'uris': [track.uri for track in self],
+            'names': [[track.name, track.artist] for track in self],
+            'requested': [pos for pos, track in self.requested()],
+        }
+
+    @classmethod
+    def load(cls, data: dict) -> 'PlaylistIndex':
+        requested = set(data['requested'])
+        names = data.get('names') or [['', '']] * len(data['uris'])
+        index = cls(Track(_track_id(uri), uri, pos in requested, *name)
+                for pos, (uri, name) in enumerate(zip(data['uris'], names)))
+        index.snapshot_id = data['snapshot_id']
+        return index
+
+    def restore_requested(self, data: dict):
+        """Carry the requested flags of an older dump over to tracks that
+        are still at the same position."""
+        uris = data['uris']
+        for pos in data['requested']:
+            if pos < len(self) and self[pos].uri == uris[pos]:
+                self.set_requested(self[pos], True)
+
+
+def _track_id(uri: str):
+    # spotify:track:<id>, local files (spotify:local:...) have no id
+    if not uri:
+        return None
+    parts = uri.split(':')
+    if len(parts) != 3 or parts[1] == 'local':
+        return None
+    return parts[2]
+
+
+def _track(item: dict) -> Track:
+    # unavailable items come back as null, keep a placeholder so the
+    # positions of everything after them stay correct
+    track = item.get('track') or {}
+    artists = track.get('artists') or [{}]
+    return Track(track.get('id'), track.get('uri'), name=track.get('name') or '',
+            artist=artists[0].get('name') or '')
+
+
+async def fetch_tracks(sp, playlist_id: str, concurrency: int = 8) -> list:
+    """Load every track of a playlist in order.
+
+    The first page tells the playlist ``total``; the remaining pages are
+    then requested concurrently, at most ``concurrency`` at a time.
+
+    :param sp: an :class:`~spotify_async.AsyncSpotify` client
+    :param playlist_id: playlist id or uri
+    """
+    async def page(offset):
+        async with fanout:
+            return await sp.playlist_items(playlist_id, fields=TRACK_FIELDS,
+                    limit=PAGE_SIZE, offset=offset, additional_types=['track'])
+
+    fanout = asyncio.Semaphore(concurrency)
+    first = await page(0)
+    rest = await asyncio.gather(*(page(offset)
+            for offset in range(PAGE_SIZE, first['total'], PAGE_SIZE)))
+
+    tracks = []
+    for response in (first, *rest):
+        tracks.extend(_track(item) for item in response['items'])
+    return tracks
+
+
+def read_cache(path: str):
+    """Return a :meth:`PlaylistIndex.dump` stored at ``path`` or :code:`None`."""
+    try:
+        with open(path, 'r') as _f:
+            return json.load(_f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(path: str, data: dict):
+    """Atomically store a :meth:`PlaylistIndex.dump` at ``path``."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as _f:
+        json.dump(data, _f, separators=(',', ':'))
+    os.replace(tmp, path)
@@ -0,0 +1,120 @@
+"""
+Request batching
+================
+
+Song requests that arrive close together are written to the playlist
+together. :meth:`RequestBatcher.add` queues a resolved track and waits;
+after ``window`` seconds all queued tracks get their final positions at once
+and every contiguous run of them is added with a single
+``playlist_add_items`` call, instead of one write per request racing for the
+same offset.
+
+The :class:`~playlist.PlaylistIndex` is only changed after Spotify accepted a
+write, so it never shows tracks the playlist doesn't have. Batches are
+committed one at a time; requests arriving meanwhile form the next batch.
+"""
+import asyncio
+
+from playlist import Track
+
+__all__ = ['RequestBatcher']
+
+
+class _Request:
+    __slots__ = ('track', 'current_id', 'future')
+
+    def __init__(self, track: dict, current_id: str, future):
+        self.track = track
+        self.current_id = current_id
+        self.future = future
+
+
+class RequestBatcher:
+    """Coalesces playlist additions.
+
+    :param sp: an :class:`~spotify_async.AsyncSpotify` client
+    :param playlist_id: playlist the requests are added to
+    :param index: returns the :class:`~playlist.PlaylistIndex` of the playlist
+    :param window: seconds to collect requests before writing them
+    :param max_batch: most tracks per ``playlist_add_items`` call
+    """
+
+    def __init__(self, sp, playlist_id: str, index, window: float = 0.25, max_batch: int = 100):
+        self.sp = sp
+        self.playlist_id = playlist_id
+        self.index = index
+        self.window = window
+        self.max_batch = max_batch
+        self.requests = 0
+        self.writes = 0
+        self._queue = []
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    async def add(self, track: dict, current_id: str) -> int:
+        """Queue ``{id, uri, name, artist}`` to play after ``current_id``
+        and the requests already queued behind it. Returns the playlist
+        position it was added at, or raises if the write failed."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append(_Request(track, current_id, future))
+        self.requests += 1
+        if self._timer is None:
+            self._timer = asyncio.ensure_future(self._commit_later())
+        return await future
+
+    async def _commit_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        """Write everything queued right now."""
+        async with self._lock:
+            batch, self._queue = self._queue, []
+            if batch:
+                await self._commit(batch)
+
+    @staticmethod
+    def _runs(index, batch) -> dict:
+        # every request lands at the insertion point of its current track;
+        # requests sharing an insertion point form one contiguous run
+        runs = {}
+        for request in batch:
+            runs.setdefault(index.insertion_point(request.current_id), []).append(request)
+        return runs
+
+    async def _commit(self, batch):
+        index = self.index()
+        runs = self._runs(index, batch)
+
+        # later positions first, so the positions of earlier runs stay valid
+        done = {}
+        for base in sorted(runs, reverse=True):
+            run = runs[base]
+            try:
+                for start in range(0, len(run), self.max_batch):
+                    chunk = run[start:start + self.max_batch]
+                    result = await self.sp.playlist_add_items(self.playlist_id,
+                            [r.track['uri'] for r in chunk], base + start)
+                    self.writes += 1
+                    for k, r in enumerate(chunk, base + start):
+                        t = r.track
+                        index.insert(k, Track(t['id'], t['uri'], True, t['name'], t['artist']))
+                    index.snapshot_id = result['snapshot_id']
+                    done.setdefault(base, []).extend(chunk)
+            except Exception as e:
+                for r in run:
+                    if r not in done.get(base, ()) and not r.future.done():
+                        r.future.set_exception(e)
+
+        # final positions, shifted by the committed runs in front of them
+        shift = 0
+        for base in sorted(done):
+            for k, r in enumerate(done[base]):
+                if not r.future.done():
+                    r.future.set_result(base + shift + k)
+            shift += len(done[base])
+
+    async def close(self):
+        """Write what is still queued instead of waiting for the window."""
+        await self.flush()
@@ -0,0 +1,233 @@
+"""
+Search cache
+============
+
+Viewers keep requesting the same popular songs, often with the same query
+typed a few times in a row. :class:`SearchCache` sits in front of the
+Spotify search endpoint and remembers the first hit of each query, so a
+repeat request skips the round trip entirely.
+
+Queries are normalized (unicode compatibility form, case folded, whitespace
+collapsed) before lookup. Entries expire after ``ttl`` seconds and the least
+recently used ones are evicted once there are more than ``max_size``, except
+for entries whose track is still in the playlist: those are pinned.
+
+A :class:`SearchStore` can back the cache with an SQLite table, so results
+survive restarts and are shared by every bot process using the database. It
+talks to SQLite on its own thread, since another process may hold the write
+lock; expired rows are deleted when it opens and every ``PURGE_EVERY`` writes.
+"""
+import asyncio
+import json
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['normalize', 'SearchStore', 'SearchCache']
+
+PURGE_EVERY = 500
+"""Writes between deleting expired rows of a :class:`SearchStore`"""
+
+
+def normalize(query: str) -> str:
+    """``'  Never  Gonna GIVE you up '`` -> ``'never gonna give you up'``"""
+    return ' '.join(unicodedata.normalize('NFKC', query).casefold().split())
+
+
+def _track(item: dict) -> dict:
+    return {
+        'id': item['id'],
+        'uri': item['uri'],
+        'name': item['name'],
+        'artist': item['artists'][0]['name'] if item['artists'] else '',
+    }
+
+
+class SearchStore:
+    """Search results in SQLite, shared between processes.
+
+    Every call runs on the store's own thread, so a database locked by
+    another process never blocks the event loop.
+
+    :param path: database file
+    """
+
+    def __init__(self, path: str = 'bopbot.db'):
+        self.path = path
+        self._con = None
+        self._writes = 0
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='search-store')
+        self._executor.submit(self._open)
+
+    def _open(self):
+        try:
+            self._con = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._con.execute('PRAGMA journal_mode=WAL')
+            self._con.execute('PRAGMA synchronous=NORMAL')
+            self._con.execute('CREATE TABLE IF NOT EXISTS search_cache '
+                    '(query TEXT PRIMARY KEY, track TEXT, expires REAL NOT NULL)')
+            self._purge()
+        except sqlite3.Error:
+            self._con = None
+
+    def _purge(self):
+        self._con.execute('DELETE FROM search_cache WHERE expires < ?', (time.time(),))
+
+    def _get(self, key: str):
+        if self._con is None:
+            return None
+        try:
+            row = self._con.execute('SELECT expires, track FROM search_cache WHERE query = ?',
+                    (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]) if row[1] else None
+
+    def _put(self, key: str, track, expires: float):
+        if self._con is None:
+            return
+        try:
+            self._con.execute('INSERT OR REPLACE INTO search_cache (query, track, expires) VALUES (?, ?, ?)',
+                    (key, json.dumps(track) if track else None, expires))
+            self._writes += 1
+            if self._writes % PURGE_EVERY == 0:
+                self._purge()
+        except sqlite3.Error:
+            pass
+
+    async def get(self, key: str):
+        """``(expires, track)`` stored for ``key`` or :code:`None`; expiry
+        is wall clock time."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._get, key)
+
+    def put(self, key: str, track, expires: float):
+        """Store ``track`` for ``key`` in the background."""
+        self._executor.submit(self._put, key, track, expires)
+
+    def close(self):
+        def close():
+            if self._con is not None:
+                self._con.close()
+        self._executor.submit(close)
+        self._executor.shutdown(wait=True)
+
+
+class SearchCache:
+    """LRU/TTL cache of track searches.
+
+    :param sp: an :class:`~spotify_async.AsyncSpotify` client
+    :param max_size: unpinned entries kept before the least recently used
+        one is evicted
+    :param ttl: seconds a result stays valid
+    :param negative_ttl: seconds a search without result stays valid
+    :param pinned: ``pinned(track_id)`` returns :code:`True` while an entry
+        must not expire or be evicted
+    :param store: optional :class:`SearchStore` consulted before Spotify
+    """
+
+    def __init__(self, sp, max_size: int = 512, ttl: float = 3600.0,
+                 negative_ttl: float = 60.0, pinned=None, store: SearchStore = None):
+        self.sp = sp
+        self.store = store
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.pinned = pinned or (lambda track_id: False)
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_pinned(self, entry) -> bool:
+        track = entry[1]
+        return track is not None and self.pinned(track['id'])
+
+    def _lookup(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic() and not self._is_pinned(entry):
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key: str, track, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl if track is not None else self.negative_ttl
+        self._entries[key] = (time.monotonic() + ttl, track)
+        self._entries.move_to_end(key)
+
+        over = len(self._entries) - self.max_size
+        if over <= 0:
+            return
+        for k in [k for k, e in self._entries.items() if not self._is_pinned(e)][:over]:
+            del self._entries[k]
+            self.evictions += 1
+
+    async def search(self, query: str):
+        """First track matching ``query`` as ``{id, uri, name, artist}``, or
+        :code:`None` if Spotify found nothing."""
+        key = normalize(query)
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+
+        #the same query typed twice in a row shares one request
+        if key in self._pending:
+            self.hits += 1
+            return await asyncio.shield(self._pending[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            #another process may have searched for it already
+            shared = await self.store.get(key) if self.store else None
+            if shared and shared[0] > time.time():
+                self.shared_hits += 1
+                track = shared[1]
+                self._store(key, track, shared[0] - time.time())
+            else:
+                self.misses += 1
+                results = await self.sp.search(q=query, limit=1, type='track')
+                items = results['tracks']['items']
+                track = _track(items[0]) if items else None
+                self._store(key, track)
+                if self.store:
+                    ttl = self.ttl if track is not None else self.negative_ttl
+                    self.store.put(key, track, time.time() + ttl)
+            future.set_result(track)
+            return track
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._pending[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
@@ -0,0 +1,328 @@
+"""
+Asyncio Spotify client
+======================
+
+A small aiohttp based replacement for the blocking :class:`spotipy.Spotify`
+calls used by the chat handlers. Authorization is still handled by a spotipy
+auth manager (:class:`spotipy.oauth2.SpotifyOAuth`), but only its token cache
+is touched on the event loop; refreshing is pushed to a worker thread and
+shared between all concurrent callers.
+
+Every call goes through one gateway: a client-side token bucket keeps the bot
+under Spotify's rate limit, ``429`` answers pause all calls for the
+``Retry-After`` time, ``5xx`` answers and network errors are retried with
+exponential backoff, and a :class:`CircuitBreaker` fails calls fast while
+Spotify keeps failing, so a brownout doesn't pile up blocked handlers.
+
+Only reads are retried on any transient error. A playlist write that timed
+out or got a ``5xx`` may still have been applied, so writes are only
+repeated after a ``429`` or when the connection couldn't be made at all.
+"""
+import asyncio
+import functools
+import json
+import os
+import random
+import time
+
+import aiohttp
+from spotipy.cache_handler import CacheFileHandler
+
+__all__ = ['SpotifyException', 'SpotifyUnavailable', 'TokenBucket', 'CircuitBreaker',
+           'PrivateCacheFileHandler', 'AsyncSpotify']
+
+API_BASE_URL = 'https://api.spotify.com/v1/'
+MAX_PLAYLIST_BATCH = 100
+"""Most items a single playlist add or remove call accepts"""
+MAX_RETRIES = 3
+MAX_WAIT = 10.0
+"""Longest a call waits for the rate limit before giving up"""
+RETRY_STATUS = (500, 502, 503, 504)
+
+
+class SpotifyException(Exception):
+    """Raised when the Spotify Web API answers with an error status."""
+
+    def __init__(self, http_status: int, msg: str, headers=None):
+        super().__init__(f'http status: {http_status}, {msg}')
+        self.http_status = http_status
+        self.msg = msg
+        self.headers = headers or {}
+
+
+class SpotifyUnavailable(SpotifyException):
+    """Raised without calling Spotify when the circuit is open or the rate
+    limit would make the call wait longer than ``MAX_WAIT``."""
+
+    def __init__(self, msg: str, retry_after: float = 0.0):
+        super().__init__(503, msg)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Client-side rate limit: ``rate`` calls per second, bursts of up to
+    ``capacity``."""
+
+    def __init__(self, rate: float = 10.0, capacity: int = 20):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._stamp = time.monotonic()
+        self.blocked_until = 0.0
+        """Set from ``Retry-After``, no call is sent before this time"""
+
+    def delay(self) -> float:
+        """Take a token and return how long to wait before using it."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        self._tokens -= 1
+        wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def give_back(self):
+        self._tokens = min(self.capacity, self._tokens + 1)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` failed calls in a row. While open, calls
+    fail fast; after ``reset_timeout`` seconds a single probe call is let
+    through and closes the circuit again if it succeeds."""
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probe = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def check(self):
+        state = self.state
+        now = time.monotonic()
+        # a probe that never reported back (e.g. cancelled) is given up on
+        probing = self._probe is not None and now - self._probe < self.reset_timeout
+        if state == 'open' or (state == 'half-open' and probing):
+            raise SpotifyUnavailable('Spotify is unavailable, circuit open.',
+                    max(self.opened_at + self.reset_timeout - now, 0.0))
+        if state == 'half-open':
+            self._probe = now
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe = None
+
+    def failure(self):
+        self.failures += 1
+        if self._probe is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self._probe = None
+
+
+def _transient(e: Exception) -> bool:
+    if isinstance(e, SpotifyException):
+        return e.http_status == 429 or e.http_status in RETRY_STATUS
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def _retryable(method: str, e: Exception) -> bool:
+    if method == 'GET':
+        return True
+    # a write is only repeated if Spotify can't have applied it
+    if isinstance(e, SpotifyException):
+        return e.http_status == 429
+    return isinstance(e, aiohttp.ClientConnectorError)
+
+
+class PrivateCacheFileHandler(CacheFileHandler):
+    """Token cache file only its owner can read, created that way instead of
+    being restricted after the token was written."""
+
+    def save_token_to_cache(self, token_info):
+        fd = os.open(self.cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(token_info, f, cls=self.encoder_cls)
+        # an existing file keeps its mode on open
+        os.chmod(self.cache_path, 0o600)
+
+
+def _playlist_id(playlist: str) -> str:
+    return playlist.split(':')[-1]
+
+
+class AsyncSpotify:
+    """Asyncio Spotify Web API client.
+
+    Method names and return values mirror :class:`spotipy.Spotify` so the
+    handlers read the same as before, they only have to be awaited.
+
+    :param auth_manager: a spotipy auth manager providing the access token
+    :param session: optional shared :class:`aiohttp.ClientSession`
+    :param bucket: client-side :class:`TokenBucket`
+    :param breaker: :class:`CircuitBreaker` shared by all calls
+    """
+
+    def __init__(self, auth_manager, session: aiohttp.ClientSession = None,
+                 bucket: TokenBucket = None, breaker: CircuitBreaker = None):
+        self.auth_manager = auth_manager
+        self.bucket = bucket or TokenBucket()
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = 0
+        self._session = session
+        self._own_session = session is None
+        self._token = None
+        self._token_lock = asyncio.Lock()
+        self._refresh_task = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=10, keepalive_timeout=60),
+                    timeout=aiohttp.ClientTimeout(total=15))
+            self._own_session = True
+        return self._session
+
+    def _token_valid(self) -> bool:
+        return self._token is not None and self._token['expires_at'] - time.time() > 60
+
+    async def get_token(self) -> str:
+        """Return a valid access token, refreshing it at most once for all
+        waiting callers."""
+        if self._token_valid():
+            return self._token['access_token']
+        async with self._token_lock:
+            if not self._token_valid():
+                loop = asyncio.get_running_loop()
+                # spotipy refreshes with blocking requests, keep it off the loop
+                # use the token spotipy returns, its cache write may have failed
+                self._token = await loop.run_in_executor(None, functools.partial(
+                        self.auth_manager.get_access_token, as_dict=True))
+        return self._token['access_token']
+
+    async def _keep_fresh(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await self.get_token()
+                await asyncio.sleep(max(self._token['expires_at'] - time.time() - 300, 30))
+                async with self._token_lock:
+                    self._token = await loop.run_in_executor(None,
+                            self.auth_manager.refresh_access_token, self._token['refresh_token'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # keep using the current token, get_token refreshes on demand
+                await asyncio.sleep(30)
+
+    def start_refresh(self):
+        """Refresh the access token in the background a few minutes before
+        it expires, so requests never wait for it."""
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self._keep_fresh())
+
+    async def _request(self, method: str, path: str, params: dict = None, payload=None):
+        if params:
+            params = {k: v for k, v in params.items() if v is not None}
+        self.breaker.check()
+        retries = 0
+        while True:
+            wait = self.bucket.delay()
+            if wait > MAX_WAIT:
+                # don't queue up behind a long Retry-After, fail right away
+                self.bucket.give_back()
+                raise SpotifyUnavailable('Spotify is rate limiting, try again later.', wait)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                result = await self._send(method, path, params, payload)
+            except Exception as e:
+                if not _transient(e):
+                    # Spotify answered, it just didn't like the call
+                    self.breaker.success()
+                    raise
+                if isinstance(e, SpotifyException) and e.http_status == 429:
+                    self.bucket.block(float(e.headers.get('Retry-After', 1)))
+                if retries >= MAX_RETRIES or not _retryable(method, e):
+                    self.breaker.failure()
+                    raise
+                retries += 1
+                self.retries += 1
+                if not (isinstance(e, SpotifyException) and e.http_status == 429):
+                    await asyncio.sleep(min(0.5 * 2 ** retries, 8) * random.uniform(0.5, 1))
+                continue
+            self.breaker.success()
+            return result
+
+    async def _send(self, method: str, path: str, params: dict = None, payload=None):
+        session = await self._get_session()
+        headers = {'Authorization': 'Bearer ' + await self.get_token()}
+        async with session.request(method, API_BASE_URL + path,
+                params=params, json=payload, headers=headers) as response:
+            if response.status >= 400:
+                try:
+                    msg = (await response.json())['error']['message']
+                except Exception:
+                    msg = await response.text()
+                raise SpotifyException(response.status, msg, response.headers)
+            if response.status == 204:
+                return None
+            text = await response.text()
+            if not text:
+                return None
+            return await response.json(content_type=None)
+
+    async def currently_playing(self, market: str = None, additional_types: str = None):
+        return await self._request('GET', 'me/player/currently-playing',
+                {'market': market, 'additional_types': additional_types})
+
+    async def search(self, q: str, limit: int = 10, offset: int = 0, type: str = 'track', market: str = None):
+        return await self._request('GET', 'search',
+                {'q': q, 'limit': limit, 'offset': offset, 'type': type, 'market': market})
+
+    async def playlist(self, playlist_id: str, fields: str = None, market: str = None):
+        return await self._request('GET', 'playlists/' + _playlist_id(playlist_id),
+                {'fields': fields, 'market': market})
+
+    async def playlist_items(self, playlist_id: str, fields: str = None, limit: int = 100,
+                             offset: int = 0, market: str = None, additional_types=('track', 'episode')):
+        return await self._request('GET', 'playlists/' + _playlist_id(playlist_id) + '/tracks',
+                {'fields': fields, 'limit': limit, 'offset': offset, 'market': market,
+                 'additional_types': ','.join(additional_types)})
+
+    async def playlist_add_items(self, playlist_id: str, items: list, position: int = None):
+        uris = [i if i.startswith('spotify:') else 'spotify:track:' + i for i in items]
+        return await self._request('POST', 'playlists/' + _playlist_id(playlist_id) + '/tracks',
+                {'position': position}, {'uris': uris})
+
+    async def playlist_remove_specific_occurrences_of_items(self, playlist_id: str, items: list,
+                                                             snapshot_id: str = None):
+        tracks = []
+        for item in items:
+            uri = item['uri']
+            if not uri.startswith('spotify:'):
+                uri = 'spotify:track:' + uri
+            tracks.append({'uri': uri, 'positions': item['positions']})
+        payload = {'tracks': tracks}
+        if snapshot_id:
+            payload['snapshot_id'] = snapshot_id
+        return await self._request('DELETE', 'playlists/' + _playlist_id(playlist_id) + '/tracks',
+                payload=payload)
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self._own_session and self._session is not None:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,37 @@
+function log(line) {
+    var status = document.getElementById('status');
+    if (!status) return;
+    status.value += line + '\n';
+    status.scrollTop = status.scrollHeight;
+}
+
+function poll(job) {
+    fetch('/app/api?job=' + job.id)
+        .then(function (r) { return r.json(); })
+        .then(function (job) {
+            if (job.state == 'running') {
+                setTimeout(function () { poll(job); }, 1000);
+            } else {
+                log(job.cmd + ': ' + JSON.stringify(job.result));
+            }
+        });
+}
+
+function command(cmd) {
+    fetch('/app/api?cmd=' + encodeURIComponent(cmd))
+        .then(function (r) { return r.json(); })
+        .then(function (result) {
+            if (result.state == 'running') {
+                log(result.cmd + ': running...');
+                poll(result);
+            } else {
+                log(cmd + ': ' + JSON.stringify(result));
+            }
+        });
+}
+
+window.addEventListener('load', function () {
+    if (!document.getElementById('status')) return;
+    var events = new EventSource('/app/status');
+    events.onmessage = function (e) { log(e.data); };
+});
@@ -0,0 +1,169 @@
+"""
+Status log writer
+=================
+
+``status()`` only hands a record to :class:`StatusWriter`; formatting and all
+file or console output happen on a writer thread that batches records and
+flushes once per batch, on a size or time trigger. Log files are rotated by
+size and can optionally be written as JSON lines.
+"""
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+__all__ = ['format_record', 'StatusWriter']
+
+
+def format_record(record) -> str:
+    """``(id, time, args)`` -> the status line"""
+    return ' '.join(map(str, record[2]))
+
+
+class _Reopen:
+    __slots__ = ('path', 'json_lines')
+
+    def __init__(self, path, json_lines):
+        self.path = path
+        self.json_lines = json_lines
+
+
+class StatusWriter:
+    """Background writer for status records.
+
+    :param path: log file, :code:`None` writes to stdout
+    :param json_lines: write ``{"id", "time", "text"}`` objects instead of
+        plain lines
+    :param max_bytes: rotate the log file once it grows past this size,
+        ``0`` never rotates
+    :param backups: rotated files to keep (``path.1`` ... ``path.N``)
+    :param batch_size: most records written per flush
+    :param interval: seconds to wait for more records before flushing
+    """
+
+    def __init__(self, path: str = None, json_lines: bool = False, max_bytes: int = 1024 * 1024,
+                 backups: int = 3, batch_size: int = 200, interval: float = 0.25):
+        self.path = path
+        self.json_lines = json_lines
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, record):
+        """Queue ``(id, time, args)``; this is all the caller pays for."""
+        if self._thread is None:
+            self._start()
+        self._queue.put(record)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='status-writer', daemon=True)
+                self._thread.start()
+
+    def reopen(self, path: str = None, json_lines: bool = False):
+        """Write the records queued from now on to ``path``."""
+        self.put(_Reopen(path, json_lines))
+
+    def flush(self):
+        """Block until everything queued so far is written."""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _format(self, record) -> str:
+        if self.json_lines:
+            return json.dumps({'id': record[0], 'time': record[1], 'text': format_record(record)})
+        return format_record(record)
+
+    def _open(self):
+        if self._file is None and self.path:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        return self._file
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+    def _write(self, lines: list):
+        data = ''.join(line + '\n' for line in lines)
+        if not self.path:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+        f = self._open()
+        f.write(data)
+        f.flush()
+        if self.max_bytes and f.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _write_safe(self, lines: list):
+        try:
+            if lines:
+                self._write(lines)
+        except Exception:
+            pass
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            lines = []
+            waiting = []
+            stop = False
+            deadline = time.monotonic() + self.interval
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiting.append(item)
+                elif isinstance(item, _Reopen):
+                    self._write_safe(lines)
+                    lines = []
+                    if self._file:
+                        self._file.close()
+                        self._file = None
+                    self.path = item.path
+                    self.json_lines = item.json_lines
+                else:
+                    lines.append(self._format(item))
+                if stop or waiting or len(lines) >= self.batch_size:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            self._write_safe(lines)
+            for done in waiting:
+                done.set()
+            if stop:
+                if self._file:
+                    self._file.close()
+                    self._file = None
+                return
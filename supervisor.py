@@ -0,0 +1,260 @@
+"""
+Supervisor
+==========
+
+Spreads the configured channels over several bot processes, so the bot isn't
+limited to one core. Every worker is a normal bot process started with
+``--shard <channel>,<channel>...``; it serves only those channels over its
+own chat connection and is driven over its stdin like the console.
+
+Channels are assigned with a consistent hash (:class:`HashRing`), so adding
+or removing a worker only moves the channels that hash to it instead of
+reshuffling everything. A worker that moves channels is stopped with
+``handoff`` first, which writes its credits and playlist cache without
+cleaning up the playlist, then started again with its new channels.
+
+Workers that crash or fail to start are retried with exponential backoff.
+Their status lines are read from stdout on a thread per worker and handed to
+``on_line`` on the event loop, tagged with the worker id; plain
+:mod:`subprocess` is used because the selector loop the web ui needs on
+Windows can't run asyncio subprocesses. State shared between workers (the
+credit ledger and the search cache) lives in the SQLite database every
+worker opens.
+"""
+import asyncio
+import bisect
+import hashlib
+import subprocess
+import sys
+import threading
+import time
+
+__all__ = ['HashRing', 'Worker', 'Supervisor']
+
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+STABLE_AFTER = 60.0
+"""Seconds a worker has to run before its restart backoff is reset"""
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring.
+
+    :param nodes: initial node names
+    :param replicas: points per node on the ring, more spread keys more
+        evenly
+    """
+
+    def __init__(self, nodes=(), replicas: int = 64):
+        self.replicas = replicas
+        self._points = []
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str):
+        for i in range(self.replicas):
+            point = _hash(f'{node}#{i}')
+            bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node: str):
+        for i in range(self.replicas):
+            point = _hash(f'{node}#{i}')
+            self._points.remove(point)
+            del self._nodes[point]
+
+    def node_for(self, key: str) -> str:
+        """The node owning ``key``: the first point clockwise of its hash."""
+        if not self._points:
+            raise LookupError('hash ring is empty')
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[self._points[i]]
+
+    def assign(self, keys) -> dict:
+        """``{node: [keys]}`` for every node owning at least one key."""
+        result = {}
+        for key in keys:
+            result.setdefault(self.node_for(key), []).append(key)
+        return result
+
+
+def worker_command(channels) -> list:
+    """Command line starting a worker for ``channels``."""
+    shard = ['--shard', ','.join(channels)]
+    if getattr(sys, 'frozen', False):
+        return [sys.executable] + shard
+    return [sys.executable, sys.argv[0]] + shard
+
+
+class Worker:
+    """One worker process and the channels it serves."""
+
+    def __init__(self, id: int, channels: list):
+        self.id = id
+        self.channels = channels
+        self.process = None
+        self.restarts = 0
+        self.started_at = 0.0
+        self.stopping = False
+        self._exited = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    async def start(self, on_line):
+        loop = asyncio.get_running_loop()
+        self.process = subprocess.Popen(worker_command(self.channels),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.started_at = time.monotonic()
+        self._exited = loop.create_future()
+        threading.Thread(target=self._read, args=(loop, self.process, self._exited, on_line),
+                name=f'worker-{self.id}', daemon=True).start()
+
+    def _read(self, loop, process, exited, on_line):
+        def call(*args):
+            try:
+                loop.call_soon_threadsafe(*args)
+            except RuntimeError:
+                # the loop is closed, nobody is listening anymore
+                pass
+        for line in process.stdout:
+            call(on_line, self, line.decode('utf-8', 'replace').rstrip('\r\n'))
+        code = process.wait()
+        call(lambda: exited.done() or exited.set_result(code))
+
+    async def wait(self) -> int:
+        """Exit code once the process and its output are done."""
+        return await asyncio.shield(self._exited)
+
+    def send(self, line: str):
+        if self.alive:
+            try:
+                self.process.stdin.write((line + '\n').encode('utf-8'))
+                self.process.stdin.flush()
+            except OSError:
+                # exited meanwhile, the watcher takes care of it
+                pass
+
+    async def stop(self, command: str = 'quit', timeout: float = 30.0):
+        """Ask the worker to exit with ``command``, kill it after
+        ``timeout`` seconds."""
+        self.stopping = True
+        if not self.alive:
+            return
+        self.send(command)
+        try:
+            await asyncio.wait_for(self.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.wait()
+
+
+class Supervisor:
+    """Runs and rebalances the worker processes.
+
+    :param channels: names of every configured channel
+    :param workers: number of worker processes
+    :param on_line: called with ``(worker, line)`` for every status line
+    """
+
+    def __init__(self, channels: list, workers: int = 2, on_line=None):
+        self.channels = [name.lower() for name in channels]
+        self.on_line = on_line or (lambda worker, line: print(f'[{worker.id}]', line))
+        self.size = 0
+        self.ring = HashRing()
+        self.workers = {}
+        self._watchers = {}
+        self._target = workers
+
+    def owner(self, channel: str):
+        """The worker serving ``channel``, :code:`None` if it isn't running."""
+        worker = self.workers.get(self.ring.node_for(channel.lower()))
+        return worker if worker and worker.alive else None
+
+    async def start(self):
+        await self.scale(self._target)
+
+    async def scale(self, size: int):
+        """Run ``size`` workers, moving only the channels whose owner changed."""
+        size = max(1, size)
+        for i in range(self.size, size):
+            self.ring.add(f'worker-{i}')
+        for i in range(size, self.size):
+            self.ring.remove(f'worker-{i}')
+        self.size = size
+        assignment = self.ring.assign(self.channels)
+
+        # stop every worker losing or gaining channels before anyone
+        # starts on them, so no channel is ever served twice
+        changed = [worker for node, worker in self.workers.items()
+                if sorted(worker.channels) != sorted(assignment.get(node, []))]
+        await asyncio.gather(*(self._stop(worker, 'handoff') for worker in changed))
+
+        for node, names in assignment.items():
+            if node not in self.workers:
+                worker = Worker(int(node.split('-')[1]), names)
+                self.workers[node] = worker
+                self._watchers[node] = asyncio.ensure_future(self._watch(node, worker))
+
+    async def _stop(self, worker: Worker, command: str):
+        node = f'worker-{worker.id}'
+        await worker.stop(command)
+        watcher = self._watchers.pop(node, None)
+        if watcher:
+            watcher.cancel()
+        self.workers.pop(node, None)
+
+    async def _watch(self, node: str, worker: Worker):
+        delay = RESTART_DELAY
+        while not worker.stopping:
+            try:
+                await worker.start(self.on_line)
+            except Exception as e:
+                self.on_line(worker, f'Worker failed to start: {e}, retrying in {delay:.0f}s.')
+            else:
+                code = await worker.wait()
+                if worker.stopping:
+                    return
+                if time.monotonic() - worker.started_at > STABLE_AFTER:
+                    delay = RESTART_DELAY
+                self.on_line(worker, f'Worker exited with code {code}, restarting in {delay:.0f}s.')
+            worker.restarts += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+
+    def send(self, channel: str, line: str) -> bool:
+        """Send a command to the worker serving ``channel``."""
+        worker = self.owner(channel)
+        if worker is None:
+            return False
+        worker.send('channel ' + channel)
+        worker.send(line)
+        return True
+
+    def broadcast(self, line: str) -> list:
+        """Send a command to every running worker, returns their ids."""
+        sent = []
+        for worker in self.workers.values():
+            if worker.alive:
+                worker.send(line)
+                sent.append(worker.id)
+        return sent
+
+    async def stop(self):
+        await asyncio.gather(*(self._stop(worker, 'quit') for worker in list(self.workers.values())))
+
+    def stats(self) -> list:
+        return [{
+            'id': worker.id,
+            'pid': worker.process.pid if worker.process else None,
+            'alive': worker.alive,
+            'channels': worker.channels,
+            'restarts': worker.restarts,
+            'uptime': round(time.monotonic() - worker.started_at) if worker.alive else 0,
+        } for worker in sorted(self.workers.values(), key=lambda w: w.id)]
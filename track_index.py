@@ -0,0 +1,204 @@
+"""
+Local track search
+==================
+
+Most requests name a song that is already in the playlist or was requested
+earlier in the stream. :class:`TrackIndex` keeps the name and artist of every
+such track in a trigram index, so those requests are resolved in memory and
+only the rest go to Spotify search.
+
+Matching is fuzzy: the query and each track are broken into character
+trigrams and scored with the Dice coefficient, once against the track name
+and once against name and artist together, so both ``"bohemian rapsody"``
+and ``"queen bohemian rhapsody"`` find the same track. A track only counts as
+a match above ``threshold``; anything less is left to Spotify.
+
+Similar titles score high too, so a candidate also has to pass a word check:
+every query word has to match its own word of the name or artist, and every
+word of the title (without ``" - Remastered"`` style suffixes) has to be
+matched. Words of up to three letters must be exact, longer ones may be one
+typo off (two from seven letters on) but have to start with the same
+letter::
+
+    >>> index = TrackIndex()
+    >>> for i, (name, artist) in enumerate([('Yellow', 'Coldplay'),
+    ...         ('Someone Like You', 'Adele'), ('Bad Guys', 'Nyck Caution'),
+    ...         ('Bohemian Rhapsody - Remastered 2011', 'Queen')]):
+    ...     index.add({'id': str(i), 'uri': '', 'name': name, 'artist': artist})
+    >>> index.match('mellow yellow') is None
+    True
+    >>> index.match('someone like me') is None
+    True
+    >>> index.match('bad guy') is None
+    True
+    >>> index.match('queen bohemian rapsody')['id']
+    '3'
+    >>> index.match('someone like you adele')['id']
+    '1'
+"""
+import re
+
+from search_cache import normalize
+
+__all__ = ['trigrams', 'TrackIndex']
+
+_PUNCTUATION = re.compile(r'[^\w\s]+')
+_APOSTROPHES = re.compile(r"['’]")
+_BRACKETS = re.compile(r'[(\[][^)\]]*[)\]]')
+
+
+def _words(text: str) -> list:
+    """``"Don't Stop Me Now"`` -> ``['dont', 'stop', 'me', 'now']``"""
+    return _PUNCTUATION.sub(' ', _APOSTROPHES.sub('', normalize(text))).split()
+
+
+def trigrams(text: str) -> frozenset:
+    """Character trigrams of every word, padded so short words count too."""
+    grams = set()
+    for word in _words(text):
+        word = f' {word} '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return frozenset(grams)
+
+
+def _dice(a: frozenset, b: frozenset, common: int) -> float:
+    return 2 * common / (len(a) + len(b)) if a or b else 0.0
+
+
+def _title(name: str) -> str:
+    """``'Song (feat. X) - Remastered'`` -> ``'Song'``"""
+    return _BRACKETS.sub(' ', name).split(' - ')[0]
+
+
+def _distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance of ``a`` and ``b``, anything above ``limit``
+    returned as ``limit + 1``."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    row = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        prev, row[0] = row[0], i
+        for j, cb in enumerate(b, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (ca != cb))
+        if min(row) > limit:
+            return limit + 1
+    return row[-1]
+
+
+def _word_match(query: str, word: str) -> bool:
+    if query == word:
+        return True
+    if len(query) <= 3 or len(word) <= 3 or query[0] != word[0]:
+        return False
+    limit = 2 if len(word) >= 7 else 1
+    return _distance(query, word, limit) <= limit
+
+
+def _covers(query: list, title: list, rest: list) -> bool:
+    """Every query word matches its own word of ``title`` or ``rest`` and
+    every title word is matched; exact matches are paired first."""
+    words = title + rest
+    used = [False] * len(words)
+    left = []
+    for q in query:
+        for k, w in enumerate(words):
+            if not used[k] and q == w:
+                used[k] = True
+                break
+        else:
+            left.append(q)
+    for q in left:
+        for k, w in enumerate(words):
+            if not used[k] and _word_match(q, w):
+                used[k] = True
+                break
+        else:
+            return False
+    return all(used[:len(title)])
+
+
+class TrackIndex:
+    """In-memory fuzzy index of known tracks.
+
+    :param threshold: lowest score, between 0 and 1, accepted as a match
+    """
+
+    def __init__(self, threshold: float = 0.75):
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._tracks = {}
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __contains__(self, track_id):
+        return track_id in self._tracks
+
+    def add(self, track: dict):
+        """Index ``{id, uri, name, artist}``; tracks without id or name are
+        skipped."""
+        if not track.get('id') or not track.get('name') or track['id'] in self._tracks:
+            return
+        # scored without version suffixes, "- Remastered 2011" isn't typed
+        name = trigrams(_title(track['name']))
+        full = name | trigrams(track['artist'])
+        title = _words(_title(track['name']))
+        rest = [w for w in _words(track['name']) if w not in title] + _words(track['artist'])
+        self._tracks[track['id']] = (track, name, full, title, rest)
+        for gram in full:
+            self._postings.setdefault(gram, set()).add(track['id'])
+
+    def update(self, tracks):
+        """Index every :class:`~playlist.Track` of ``tracks``."""
+        for t in tracks:
+            self.add({'id': t.id, 'uri': t.uri, 'name': t.name, 'artist': t.artist})
+
+    def clear(self):
+        self._tracks.clear()
+        self._postings.clear()
+
+    def match(self, query: str):
+        """Best track for ``query`` as ``{id, uri, name, artist}``, or
+        :code:`None` if nothing scores at least ``threshold``."""
+        grams = trigrams(query)
+        if not grams:
+            self.misses += 1
+            return None
+
+        # full trigram overlap of every track sharing at least one trigram
+        overlap = {}
+        for gram in grams:
+            for track_id in self._postings.get(gram, ()):
+                overlap[track_id] = overlap.get(track_id, 0) + 1
+
+        # a Dice score >= threshold needs at least this much overlap
+        need = self.threshold * len(grams) / 2
+        scored = []
+        for track_id, common in overlap.items():
+            if common < need:
+                continue
+            track, name, full, title, rest = self._tracks[track_id]
+            score = max(_dice(grams, full, common), _dice(grams, name, len(grams & name)))
+            if score >= self.threshold:
+                scored.append((score, track_id))
+
+        # similar titles score high too, the best one whose words fit wins
+        words = _words(query)
+        for score, track_id in sorted(scored, reverse=True):
+            track, name, full, title, rest = self._tracks[track_id]
+            if _covers(words, title, rest):
+                self.hits += 1
+                return track
+        self.misses += 1
+        return None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._tracks),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,363 @@
+"""
+Web UI
+======
+
+The login, configuration and admin pages of ``bopbot_web`` mode, served by
+Twisted on top of the bot's asyncio loop.
+
+The bot only imports this module when ``bopbot_web`` is enabled, so console
+runs never pay for Twisted, markdown or bcrypt. The bot hands itself over as
+:data:`bot` (its module object, which is ``__main__`` when run as a script)
+before calling :func:`start`.
+"""
+import asyncio
+import html
+import itertools
+import json
+import sys
+
+from twisted.web import server, resource, static
+from twisted.web.util import redirectTo
+
+bot = None
+"""The running bot module"""
+
+web_port = None
+auth_sessions = []
+jobs = {}
+
+#markdown is only needed for the message pages
+def render_markdown(text, **kwargs):
+    from markdown import markdown
+    return markdown(text, **kwargs)
+
+#serve the web ui from twisted running on top of our asyncio loop
+async def start():
+
+    global web_port
+    if web_port: return
+
+    if not 'twisted.internet.reactor' in sys.modules:
+        from twisted.internet import asyncioreactor
+        asyncioreactor.install(asyncio.get_running_loop())
+    from twisted.internet import reactor
+
+    web_port = reactor.listenTCP(8080, server.Site(root))
+    if not reactor.running:
+        reactor.startRunning(installSignalHandlers=False)
+
+    asyncio.ensure_future(status_keepalive())
+
+#comment lines keep idle event streams from being closed by proxies
+async def status_keepalive():
+    while web_port:
+        await asyncio.sleep(15)
+        for request in bot.status_listeners:
+            request.write(b': keepalive\n\n')
+
+async def stop():
+
+    global web_port
+    if not web_port: return
+
+    for request in list(bot.status_listeners):
+        request.finish()
+    await web_port.stopListening().asFuture(asyncio.get_running_loop())
+    web_port = None
+
+template = dict(
+    header = dict(title=''),
+    content = {},
+    footer = {},
+)
+
+def show_content(tmp):
+
+    header = bot.env.get_template('header.html')
+    content = bot.env.get_template(tmp)
+    footer = bot.env.get_template('footer.html')
+
+    data = header.render(**template['header'])
+    data += content.render(**template['content'])
+    data += footer.render(**template['footer'])
+
+    return data.encode('utf-8')
+
+def custom402(request):
+    request.setHeader('Content-Type', 'text/html; charset=utf-8')
+    request.setResponseCode(402)
+    template['header']['title'] = bot.app_name + ' - Not Authorized'
+    template['content']['message'] = render_markdown('#Not Authorized\n\nThe page requires authorization.')
+    return show_content('message.html')
+
+def needs_auth(session):
+    if session.uid in auth_sessions:
+        return False
+    return True
+
+class connect(resource.Resource):
+    isLeaf = True
+    def render_GET(self, request):
+        if needs_auth(request.getSession()): return custom402(request)
+        request.setHeader('Content-Type', 'text/html; charset=utf-8')
+        template['header']['title'] = bot.app_name + ' - start'
+        return show_content('start.html')
+
+def configure_get(request):
+    request.setHeader('Content-Type', 'text/html; charset=utf-8')
+    template['header']['title']  = bot.app_name + ' - configure'
+
+    template['content']['BOPBOT_WEB'] = bot.BOPBOT_WEB 
+    template['content']['TWITCH_CLIENT_ID'] = bot.TWITCH_CLIENT_ID
+    template['content']['TWITCH_SECRET'] = bot.TWITCH_SECRET
+    template['content']['TARGET_CHANNEL'] = bot.TARGET_CHANNEL
+    template['content']['SPOTIFY_CLIENT_ID'] = bot.SPOTIFY_CLIENT_ID
+    template['content']['SPOTIFY_SECRET'] = bot.SPOTIFY_SECRET
+    template['content']['SPOTIFY_PLAYLIST_URL'] = bot.SPOTIFY_PLAYLIST_URL
+    template['content']['SPOTIFY_PLAYLIST_URI'] = bot.SPOTIFY_PLAYLIST_URI
+    template['content']['SPOTIFY_REQUEST_URI'] = bot.SPOTIFY_REQUEST_URI
+    template['content']['GIFTED_REGEX'] = bot.GIFTED_REGEX
+    template['content']['BITS_REGEX'] = bot.BITS_REGEX
+    template['content']['TIP_REGEX'] = bot.TIP_REGEX
+    template['content']['SIGNAL_BOT'] = bot.SIGNAL_BOT
+    template['content']['TWITCH_REQUEST_URI'] = bot.TWITCH_REQUEST_URI
+    template['content']['AMOUNT_BITS'] = bot.AMOUNT_BITS
+    template['content']['AMOUNT_GIFTED_TIER1'] = bot.AMOUNT_GIFTED_TIER1
+    template['content']['AMOUNT_GIFTED_TIER2'] = bot.AMOUNT_GIFTED_TIER2
+    template['content']['AMOUNT_GIFTED_TIER3'] = bot.AMOUNT_GIFTED_TIER3
+    template['content']['AMOUNT_TIP'] = bot.AMOUNT_TIP
+    template['content']['REQUEST_CMD'] = bot.REQUEST_CMD
+    template['content']['SONG_CMD'] = bot.SONG_CMD
+    template['content']['CREDIT_CMD'] = bot.CREDIT_CMD
+
+    template['content']['CLEAN_PLAYLIST'] = ''
+    template['content']['DISABLE_CREDIT_CMD'] = ''
+    template['content']['DISABLE_SONG_CMD'] = ''
+    template['content']['DISABLE_REQUEST_CMD'] = ''
+    template['content']['CUMULATIVE_CREDIT'] = ''
+
+    ch = 'checked'
+    if bot.CLEAN_PLAYLIST:
+        template['content']['CLEAN_PLAYLIST'] = ch
+    if bot.DISABLE_CREDIT_CMD:
+        template['content']['DISABLE_CREDIT_CMD'] = ch
+    if bot.DISABLE_SONG_CMD:
+        template['content']['DISABLE_SONG_CMD'] = ch
+    if bot.DISABLE_REQUEST_CMD:
+        template['content']['DISABLE_REQUEST_CMD'] = ch
+    if bot.CUMULATIVE_CREDIT:
+        template['content']['CUMULATIVE_CREDIT'] = ch
+
+    template['content']['CREDIT_MESSAGE'] = bot.CREDIT_MESSAGE
+    template['content']['SONG_MESSAGE'] = bot.SONG_MESSAGE
+    template['content']['NO_SONG_MESSAGE'] = bot.NO_SONG_MESSAGE
+    template['content']['REQUEST_MESSAGE'] = bot.REQUEST_MESSAGE
+    template['content']['NOTIFY_MESSAGE'] = bot.NOTIFY_MESSAGE
+    template['content']['NOTIFY_BATCH_MESSAGE'] = bot.NOTIFY_BATCH_MESSAGE
+
+    return show_content('configure.html')
+
+def configure_post(request):
+    bot.save_conf(request)
+
+class configure(resource.Resource):
+    isLeaf = True
+    def render_GET(self, request):
+        if needs_auth(request.getSession()): return custom402(request)
+        return configure_get(request)
+
+    def render_POST(self, request):
+        if needs_auth(request.getSession()): return custom402(request)
+
+        configure_post(request)
+
+        return configure_get(request)
+    
+class login(resource.Resource):
+    isLeaf = True
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/html; charset=utf-8')
+        template['header']['title'] = bot.app_name + ' - login'
+        return show_content('login.html')
+    def render_POST(self, request):
+        
+        username = request.args[b'username'][0].decode('utf-8')
+        password = request.args[b'password'][0].decode('utf-8')
+
+        username = html.escape(username)
+        password = html.escape(password)
+
+        salt = ''
+        hashed_pass = ''
+        passwd = json.loads(open('passwd.json').read())
+
+        if username in passwd.keys():
+            salt = passwd[username]['salt']
+            hashed_pass = passwd[username]['pass'].encode('utf-8')
+        else:
+            return custom402(request)
+        
+        test = password + salt
+        import bcrypt
+        test_hash = bcrypt.hashpw(test.encode('utf-8'), salt.encode('utf-8'))
+
+        if hashed_pass == test_hash:
+            global auth_sessions
+            if not request.getSession().uid in auth_sessions:
+                auth_sessions.append(request.getSession().uid)
+            return redirectTo(b'/app/connect', request)
+
+        return custom402(request)
+
+class logout(resource.Resource):
+    isLeaf = True
+    def render_GET(self, request):
+        if needs_auth(request.getSession()): return custom402(request)
+        global auth_sessions
+        if request.getSession().uid in auth_sessions:
+            auth_sessions.remove(request.getSession().uid)
+        request.getSession().expire()
+        request.setHeader('Content-Type', 'text/html; charset=utf-8')
+        template['header']['title'] = bot.app_name + ' - logout'
+        template['content']['message'] = 'You are now logged out.'
+        return show_content('message.html')
+
+class main(resource.Resource):
+    isLeaf = True
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/html; charset=utf-8')
+        template['header']['title'] = bot.app_name
+        template['content']['message'] = render_markdown(open('README.md').read(),\
+                extensions=['extra','codehilite'], output_format='html5')
+        return show_content('message.html')
+
+#commands that may take a while run as jobs the admin page polls
+LONG_COMMANDS = (b'refresh', b'reset', b'source')
+MAX_JOBS = 100
+job_ids = itertools.count(1)
+
+def start_job(line):
+
+    job = {'id': next(job_ids), 'cmd': line, 'state': 'running', 'result': None}
+    jobs[job['id']] = job
+    while len(jobs) > MAX_JOBS:
+        del jobs[min(jobs)]
+
+    def done(task):
+        if task.exception():
+            job['state'] = 'failed'
+            job['result'] = {'ok': False, 'error': str(task.exception())}
+        else:
+            job['state'] = 'done'
+            job['result'] = task.result()
+
+    asyncio.ensure_future(bot.run_command(line)).add_done_callback(done)
+    return job
+
+def json_response(request, data, code = 200):
+    request.setHeader('Content-Type', 'application/json; charset=utf-8')
+    request.setResponseCode(code)
+    return json.dumps(data).encode('utf-8')
+
+class api(resource.Resource):
+    isLeaf = True
+    def render_GET(self, request):
+        if needs_auth(request.getSession()): return custom402(request)
+
+        if b'job' in request.args:
+            try:
+                job = jobs[int(request.args[b'job'][0])]
+            except (KeyError, ValueError):
+                return json_response(request, {'ok': False, 'error': 'Unknown job.'}, 404)
+            return json_response(request, job)
+
+        if not b'cmd' in request.args:
+            return json_response(request, {'ok': False, 'error': 'No command.'}, 400)
+
+        #cmd=give&user=a&user=b is the same as cmd=give a b
+        words = [request.args[b'cmd'][0].decode('utf-8')]
+        words += [u.decode('utf-8') for u in request.args.get(b'user', [])]
+        line = ' '.join(words)
+        if not line.split():
+            return json_response(request, {'ok': False, 'error': 'No command.'}, 400)
+
+        if line.split()[0].encode('utf-8') in LONG_COMMANDS:
+            return json_response(request, start_job(line), 202)
+
+        finished = []
+        request.notifyFinish().addErrback(lambda f: finished.append(f))
+
+        def done(task):
+            if finished: return
+            if task.exception():
+                data = {'ok': False, 'error': str(task.exception())}
+                request.write(json_response(request, data, 500))
+            else:
+                request.write(json_response(request, task.result()))
+            request.finish()
+
+        asyncio.ensure_future(bot.run_command(line)).add_done_callback(done)
+        return server.NOT_DONE_YET
+
+    render_POST = render_GET
+
+#server-sent events stream of the status lines
+class status_stream(resource.Resource):
+    isLeaf = True
+    def render_GET(self, request):
+        if needs_auth(request.getSession()): return custom402(request)
+        request.setHeader('Content-Type', 'text/event-stream; charset=utf-8')
+        request.setHeader('Cache-Control', 'no-cache')
+
+        #replay what the viewer missed, or the whole buffer for a new one
+        last = request.getHeader('Last-Event-ID')
+        try:
+            last = int(last)
+        except (TypeError, ValueError):
+            last = 0
+        request.write(b''.join(bot.status_event(e) for e in bot.status_events if e[0] > last))
+
+        bot.status_listeners.append(request)
+        request.notifyFinish().addBoth(lambda r: bot.status_listeners.remove(request))
+        return server.NOT_DONE_YET
+
+class admin(resource.Resource):
+    isLeaf = True
+    def render_GET(self, request):
+        if needs_auth(request.getSession()): return custom402(request)
+        request.setHeader('Content-Type', 'text/html; charset=utf-8')
+
+        template['header']['title'] = bot.app_name + ' - admin'
+        return show_content('admin.html')
+
+class custom404(resource.Resource):
+    isLeaf = True
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/html; charset=utf-8')
+        request.setResponseCode(404)
+        template['header']['title'] = bot.app_name + ' - Not Found'
+        template['content']['message'] = render_markdown('#Not Found\n\nThe page could not be found.')
+        return show_content('message.html')
+
+class _root(resource.Resource):
+    def getChild(self, path, request):
+        return custom404()
+
+class _auth(resource.Resource):
+    def getChild(self, path, request):
+        return custom404()
+
+root = _root()
+root.putChild(b'', main())
+root.putChild(b'static', static.File('./static'))
+app = _root()
+app.putChild(b'connect', connect())
+app.putChild(b'configure', configure())
+app.putChild(b'api', api())
+app.putChild(b'admin', admin())
+app.putChild(b'status', status_stream())
+root.putChild(b'app', app)
+auth = _root()
+auth.putChild(b'login', login())
+auth.putChild(b'logout', logout())
+root.putChild(b'auth', auth)